@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+"""Compares massban throughput against banning the same targets one at a time.
+
+Discord and Mongo are replaced by fakes that sleep for a fixed latency, while the real
+Action classes, Moderation.save_actions, run_mass_action and run_bulk do the work. The
+one-at-a-time path is what the ban command does: notify, then execute. Run with
+`python benchmarks/massban.py --api 0.06 --db 0.003 --targets 200`.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cogs import moderation
+from cogs.mongo import Mongo
+
+
+class FakeTarget:
+    def __init__(self, id, latency):
+        self.id = id
+        self.latency = latency
+        self.avatar_url = ""
+
+    def __str__(self):
+        return f"user{self.id}"
+
+    async def send(self, **kwargs):
+        await asyncio.sleep(self.latency)
+
+
+class FakeGuild:
+    def __init__(self, count, latency):
+        self.latency = latency
+        self.members = [FakeTarget(i, latency) for i in range(count)]
+        self.bans = 0
+        self.me = self.owner = None
+
+    async def ban(self, target, reason=None):
+        await asyncio.sleep(self.latency)
+        self.bans += 1
+
+
+class FakeCollection:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def bulk_write(self, ops, ordered=True):
+        await asyncio.sleep(self.latency)
+
+
+class FakeMongo:
+    next_id = Mongo.next_id
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.allocators = {}
+        self.db = SimpleNamespace(action=FakeCollection(latency), member=FakeCollection(latency))
+
+    async def reserve_id(self, name, reserve=1):
+        await asyncio.sleep(self.latency)
+        return 0
+
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeBot:
+    def __init__(self, db_latency):
+        self.loop = asyncio.get_event_loop()
+        self.mongo = FakeMongo(db_latency)
+        self.cog = None
+
+    def get_cog(self, name):
+        return self.cog
+
+    def dispatch(self, *args):
+        pass
+
+    async def wait_for(self, *args, **kwargs):
+        # Stands in for the confirmation message
+        return None
+
+
+class FakeContext:
+    def __init__(self, bot, guild):
+        self.bot = bot
+        self.guild = guild
+        self.author = SimpleNamespace(id=1, avatar_url="")
+        self.channel = None
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage()
+
+
+def make_context(args):
+    bot = FakeBot(args.db)
+    cog = moderation.Moderation.__new__(moderation.Moderation)
+    cog.bot = bot
+    cog.expiries = moderation.TimerHeap(None)
+    cog.log_queue = asyncio.Queue()
+    cog.can_punish = lambda ctx, target: True
+    bot.cog = cog
+    return FakeContext(bot, FakeGuild(args.targets, args.api))
+
+
+async def one_by_one(args):
+    ctx = make_context(args)
+    start = time.perf_counter()
+    for target in ctx.guild.members:
+        action = moderation.Ban(target=target, user=ctx.author, reason="raid")
+        await action.notify()
+        await action.execute(ctx)
+    return time.perf_counter() - start, ctx.guild.bans
+
+
+async def massban(args):
+    ctx = make_context(args)
+    start = time.perf_counter()
+    cog = ctx.bot.cog
+    await cog.run_mass_action(ctx, moderation.Ban, ctx.guild.members, "raid")
+    return time.perf_counter() - start, ctx.guild.bans
+
+
+async def main(args):
+    print(f"API latency {args.api * 1000:.0f} ms, Mongo RTT {args.db * 1000:.0f} ms")
+    for name, func in (("one-by-one", one_by_one), ("massban", massban)):
+        seconds, bans = await func(args)
+        print(f"{name:>10}: {bans} bans in {seconds:.1f}s, {bans / seconds:.1f} actions/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--api", type=float, default=0.06, help="Discord API latency in seconds")
+    parser.add_argument("--db", type=float, default=0.003, help="Mongo round trip in seconds")
+    parser.add_argument("--targets", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
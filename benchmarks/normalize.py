@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+"""Compares automod's text normalization per message against the old casefold().
+
+Run with `python benchmarks/normalize.py`.
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from helpers.matching import collapse_runs, shorten_runs, translate
+
+MESSAGES = {
+    "plain": "hey everyone, did anyone manage to finish the event yesterday? i still need two more",
+    "fullwidth/accents/runs": (
+        "ｈｅｙ éveryöne, did ânyone mánage to fïnish the event yesterdayyyyy? i stilllll need"
+    ),
+    "leetspeak/numbers": (
+        "h3y 3v3ry0n3, d1d 4ny0n3 m4n4g3 to finish the event? i scored 455 points in room 7175"
+    ),
+}
+
+
+def normalize_message(text):
+    # What automod derives from each message: the text for duplicate detection, and the
+    # collapsed text the banned word matcher runs over
+    text = translate(text)
+    return shorten_runs(text), collapse_runs(text)
+
+
+def main(number=100000):
+    print("time per message")
+    for name, text in MESSAGES.items():
+        old = min(timeit.repeat(lambda: text.casefold().split(), number=number, repeat=3))
+        new = min(timeit.repeat(lambda: normalize_message(text), number=number, repeat=3))
+        old, new = old / number * 1e6, new / number * 1e6
+        print(f"{name:>22} ({len(text)} chars): old {old:.1f} us, new {new:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+"""Compares banned word matching per message against the old set lookup.
+
+The old check split the message on whitespace and looked each word up in a set built
+from the banned list on every message. Run with `python benchmarks/phrase_matcher.py`.
+"""
+
+import random
+import string
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from helpers.matching import PhraseMatcher
+
+MESSAGE = (
+    "hey everyone, did anyone manage to finish the event yesterday? i still need two more items"
+)
+
+
+def random_word(rng):
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+
+
+def old_check(words, text):
+    banned = set(words)
+    return next((x for x in text.casefold().split() if x in banned), None)
+
+
+def main(sizes=(10, 1000, 10000), number=20000):
+    rng = random.Random(0)
+    print(f"{len(MESSAGE)}-char message, time per message")
+    for size in sizes:
+        words = [random_word(rng) for _ in range(size)]
+        matcher = PhraseMatcher(words)
+
+        old = min(timeit.repeat(lambda: old_check(words, MESSAGE), number=number, repeat=3))
+        new = min(timeit.repeat(lambda: matcher.search(MESSAGE), number=number, repeat=3))
+        old, new = old / number * 1e6, new / number * 1e6
+        print(f"{size:>6} words: old {old:.1f} us, new {new:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
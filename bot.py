@@ -4,6 +4,9 @@
 
 # Copyright (c) 2021 Oliver Ni
 
+import asyncio
+import sys
+import traceback
 from pathlib import Path
 
 import config
@@ -70,7 +73,22 @@ class Bot(commands.Bot, events.EventsMixin):
 
     async def close(self):
         print("Shutting down")
-        await super().close()
+        try:
+            for cog in list(self.cogs.values()):
+                if hasattr(cog, "flush"):
+                    await self.flush_cog(cog)
+        finally:
+            await super().close()
+
+    async def flush_cog(self, cog):
+        timeout = getattr(config, "FLUSH_TIMEOUT", 30)
+        try:
+            await asyncio.wait_for(cog.flush(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out flushing {cog.qualified_name} after {timeout}s", file=sys.stderr)
+        except Exception as error:
+            print(f"Ignoring exception flushing {cog.qualified_name}:", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -4,12 +4,55 @@
 
 # Copyright (c) 2021 Oliver Ni
 
+import asyncio
 import json
-from datetime import datetime, timedelta
+import sys
+import traceback
+from collections import Counter
+from dataclasses import InitVar, dataclass, field
+from datetime import datetime, timedelta, timezone
 
 import discord
 from discord.ext import commands, menus
+from helpers import time
+from helpers.matching import (
+    DomainTrie,
+    StretchedPhraseMatcher,
+    normalize,
+    parse_domain_rule,
+    shorten_runs,
+    translate,
+)
 from helpers.pagination import EmbedListPageSource
+from helpers.spam import SpamDetector
+
+
+@dataclass
+class AutomodConfig:
+    banned_words: list = field(default_factory=list)
+    mute_threshold: int = 10
+    mute_window: int = 3600
+    mute_duration: int = 86400
+    flood_count: int = 10
+    flood_seconds: int = 5
+    duplicate_count: int = 5
+    duplicate_seconds: int = 60
+    blocked_domains: InitVar[list] = ()
+    allowed_domains: InitVar[list] = ()
+    loaded_at: float = field(default=0, init=False)
+
+    def __post_init__(self, blocked_domains, allowed_domains):
+        self.matcher = StretchedPhraseMatcher(normalize(x) for x in self.banned_words)
+        self.domains = DomainTrie()
+        self.update_domains(blocked_domains, "block")
+        self.update_domains(allowed_domains, "allow")
+
+    def update_domains(self, rules, verdict):
+        for rule in rules:
+            if verdict is None:
+                self.domains.remove(rule)
+            else:
+                self.domains.add(rule, verdict)
 
 
 class Automod(commands.Cog):
@@ -17,16 +60,81 @@ class Automod(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.configs = {}
+        self.config_max_age = getattr(bot.config, "AUTOMOD_CACHE_MAX_AGE", 300)
+        self.spam_detectors = {}
+        self.cache_stats = Counter()
+        self._listen_task = self.bot.loop.create_task(self.listen_invalidations())
+
+    async def listen_invalidations(self, max_delay=60):
+        await self.bot.get_cog("Redis").wait_until_ready()
+        delay = 1
+        while True:
+            try:
+                (channel,) = await self.bot.redis.subscribe("automod:invalidate")
+                # Anything may have changed while we weren't subscribed
+                self.configs.clear()
+                delay = 1
+                while await channel.wait_message():
+                    self.handle_invalidation(await channel.get(encoding="utf-8"))
+            except Exception as error:
+                print("Ignoring exception in automod invalidation listener:", file=sys.stderr)
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def handle_invalidation(self, message):
+        try:
+            data = json.loads(message)
+            if "domains" in data and data["guild_id"] in self.configs:
+                self.configs[data["guild_id"]].update_domains(*data["domains"])
+                self.cache_stats["domain_updates"] += 1
+            else:
+                self.configs.pop(data["guild_id"], None)
+                self.cache_stats["invalidations"] += 1
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # We can't tell which guild changed, so drop everything
+            print(f"Ignoring bad automod invalidation: {message!r}", file=sys.stderr)
+            self.configs.clear()
+            self.cache_stats["invalidations"] += 1
+
+    async def invalidate_config(self, guild, **kwargs):
+        await self.bot.redis.delete(f"automod:{guild.id}")
+        if len(kwargs) == 0:
+            self.configs.pop(guild.id, None)
+        await self.bot.redis.publish_json("automod:invalidate", {"guild_id": guild.id, **kwargs})
 
-    async def fetch_banned_words(self, guild):
-        words = await self.bot.redis.get(f"banned_words:{guild.id}")
-        if words is None:
-            data = await self.bot.mongo.db.guild.find_one({"_id": guild.id})
-            words = [] if data is None else data.get("banned_words")
-            await self.bot.redis.set(f"banned_words:{guild.id}", json.dumps(words), expire=3600)
+    async def fetch_config_data(self, guild):
+        data = await self.bot.redis.get(f"automod:{guild.id}")
+        if data is None:
+            data = await self.bot.mongo.db.guild.find_one(
+                {"_id": guild.id},
+                {
+                    "_id": 0,
+                    "banned_words": 1,
+                    "automod": 1,
+                    "blocked_domains": 1,
+                    "allowed_domains": 1,
+                },
+            )
+            data = {} if data is None else {**data.pop("automod", {}), **data}
+            await self.bot.redis.set(f"automod:{guild.id}", json.dumps(data), expire=3600)
         else:
-            words = json.loads(words)
-        return words
+            data = json.loads(data)
+        return data
+
+    async def fetch_config(self, guild):
+        # Entries also expire, in case an invalidation was missed
+        config = self.configs.get(guild.id)
+        if config is not None and self.bot.loop.time() - config.loaded_at < self.config_max_age:
+            self.cache_stats["hits"] += 1
+            return config
+
+        self.cache_stats["misses"] += 1
+        config = AutomodConfig(**await self.fetch_config_data(guild))
+        config.loaded_at = self.bot.loop.time()
+        self.configs[guild.id] = config
+        return config
 
     async def update_banned_words(self, guild, push=None, pull=None):
         update = {}
@@ -35,44 +143,108 @@ class Automod(commands.Cog):
         if pull is not None:
             update["$pull"] = {"banned_words": {"$in": pull}}
         await self.bot.mongo.db.guild.update_one({"_id": guild.id}, update, upsert=True)
-        await self.bot.redis.delete(f"banned_words:{guild.id}")
+        await self.invalidate_config(guild)
+
+    async def update_domains(self, guild, rules, verdict):
+        if verdict == "block":
+            update = {
+                "$addToSet": {"blocked_domains": {"$each": rules}},
+                "$pull": {"allowed_domains": {"$in": rules}},
+            }
+        elif verdict == "allow":
+            update = {
+                "$addToSet": {"allowed_domains": {"$each": rules}},
+                "$pull": {"blocked_domains": {"$in": rules}},
+            }
+        else:
+            update = {
+                "$pull": {"blocked_domains": {"$in": rules}, "allowed_domains": {"$in": rules}}
+            }
+        await self.bot.mongo.db.guild.update_one({"_id": guild.id}, update, upsert=True)
+
+        # Small changes are applied to cached tries in place, large ones rebuild them
+        if len(rules) > 1000:
+            await self.invalidate_config(guild)
+        else:
+            await self.invalidate_config(guild, domains=[rules, verdict])
+
+    async def update_settings(self, guild, **kwargs):
+        update = {f"automod.{k}": v for k, v in kwargs.items()}
+        await self.bot.mongo.db.guild.update_one({"_id": guild.id}, {"$set": update}, upsert=True)
+        await self.invalidate_config(guild)
+
+    async def count_violation(self, ctx, config):
+        # Sliding window of violations per member, scored by message time
+        key = f"automod:violations:{ctx.guild.id}:{ctx.author.id}"
+        now = ctx.message.created_at.replace(tzinfo=timezone.utc).timestamp()
+
+        tr = self.bot.redis.multi_exec()
+        tr.zremrangebyscore(key, max=now - config.mute_window)
+        tr.zadd(key, now, ctx.message.id)
+        tr.zcard(key)
+        tr.expire(key, config.mute_window)
+        _, _, count, _ = await tr.execute()
+        return count
+
+    def check_message(self, message, config):
+        text = translate(message.content)
+        word = config.matcher.search(text)
+        if word is not None:
+            return f"Automod: The word `{word}` is banned, watch your language."
+
+        link = config.domains.search(message.content)
+        if link is not None:
+            return f"Automod: Links to `{link}` are not allowed."
+
+        if message.author.bot:
+            return None
+
+        if message.guild.id not in self.spam_detectors:
+            self.spam_detectors[message.guild.id] = SpamDetector()
+        detector = self.spam_detectors[message.guild.id]
+        now = message.created_at.replace(tzinfo=timezone.utc).timestamp()
+
+        if detector.check_flood(message.author.id, now, config.flood_count, config.flood_seconds):
+            return "Automod: You are sending messages too quickly."
+        if detector.check_duplicate(
+            shorten_runs(text),
+            message.author.id,
+            now,
+            config.duplicate_count,
+            config.duplicate_seconds,
+        ):
+            return "Automod: This message has been sent too many times."
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.guild is None:
             return
 
-        words = message.content.casefold().split()
-        banned = set(await self.fetch_banned_words(message.guild))
-
-        word = discord.utils.find(lambda x: x in banned, words)
-        if word is not None and not message.author.permissions_in(message.channel).administrator:
+        config = await self.fetch_config(message.guild)
+        reason = self.check_message(message, config)
+        if reason is not None and not message.author.permissions_in(message.channel).administrator:
             ctx = await self.bot.get_context(message)
-            await self.automod_punish(ctx, word)
+            await self.automod_punish(ctx, reason)
 
-    async def automod_punish(self, ctx, word):
+    async def automod_punish(self, ctx, reason):
         await ctx.message.delete()
         cog = self.bot.get_cog("Moderation")
         if cog is None:
             return
 
-        query = {
-            "target_id": ctx.author.id,
-            "user_id": self.bot.user.id,
-            "created_at": {"$gt": datetime.utcnow() - timedelta(hours=1)},
-        }
-        count = await self.bot.mongo.db.action.count_documents(query) + 1
+        config = await self.fetch_config(ctx.guild)
+        count = await self.count_violation(ctx, config)
 
         kwargs = {
             "target": ctx.author,
             "user": self.bot.user,
-            "reason": f"Automod: The word `{word}` is banned, watch your language.",
+            "reason": reason,
             "created_at": datetime.utcnow(),
         }
 
-        if count >= 10:
+        if count >= config.mute_threshold:
             action_cls = cog.cls_dict["mute"]
-            kwargs["expires_at"] = kwargs["created_at"] + timedelta(days=1)
+            kwargs["expires_at"] = kwargs["created_at"] + timedelta(seconds=config.mute_duration)
         else:
             action_cls = cog.cls_dict["warn"]
 
@@ -95,9 +267,10 @@ class Automod(commands.Cog):
         You must have the Administrator permission to use this.
         """
 
+        config = await self.fetch_config(ctx.guild)
         pages = menus.MenuPages(
             source=EmbedListPageSource(
-                await self.fetch_banned_words(ctx.guild),
+                config.banned_words,
                 title="Banned Words",
                 show_index=True,
             )
@@ -109,6 +282,9 @@ class Automod(commands.Cog):
     async def add(self, ctx, *words):
         """Adds words to the banned words list.
 
+        Wrap phrases in quotes to match several words together. A leading or trailing * also
+        matches the word inside other words, e.g. *word*.
+
         You must have the Administrator permission to use this.
         """
 
@@ -128,6 +304,207 @@ class Automod(commands.Cog):
         words_msg = ", ".join(f"**{x}**" for x in words)
         await ctx.send(f"Removed {words_msg} from the banned words list.")
 
+    @automod.command()
+    @commands.has_permissions(administrator=True)
+    async def escalation(
+        self,
+        ctx,
+        threshold: int = None,
+        window: time.TimeDelta = None,
+        duration: time.TimeDelta = None,
+    ):
+        """Configures when automod violations escalate from warns to mutes.
+
+        Members are muted for the given duration once they reach the threshold number of
+        violations within the window. With no arguments, displays the current settings.
+
+        You must have the Administrator permission to use this.
+        """
+
+        if threshold is not None:
+            if threshold < 1:
+                return await ctx.send("The threshold must be at least 1.")
+            if any(x is not None and x.total_seconds() < 1 for x in (window, duration)):
+                return await ctx.send("The window and duration must be at least 1 second.")
+            kwargs = {"mute_threshold": threshold}
+            if window is not None:
+                kwargs["mute_window"] = int(window.total_seconds())
+            if duration is not None:
+                kwargs["mute_duration"] = int(duration.total_seconds())
+            await self.update_settings(ctx.guild, **kwargs)
+
+        config = await self.fetch_config(ctx.guild)
+        window = time.strfdelta(timedelta(seconds=config.mute_window), long=True)
+        duration = time.strfdelta(timedelta(seconds=config.mute_duration), long=True)
+        await ctx.send(
+            f"Members are muted for **{duration}** after **{config.mute_threshold}** violations within **{window}**."
+        )
+
+    def parse_domain_rules(self, rules):
+        parsed = [parse_domain_rule(x) for x in rules]
+        return [x for x in parsed if x is not None], [x for x, y in zip(rules, parsed) if y is None]
+
+    async def send_domain_update(self, ctx, rules, invalid, message):
+        if len(rules) == 0:
+            return await ctx.send("No valid domains were provided.")
+        if len(rules) > 20:
+            msg = message.format(f"**{len(rules)}** domains")
+        else:
+            msg = message.format(", ".join(f"**{x}**" for x in rules))
+        if len(invalid) > 0:
+            msg += f"\nSkipped {len(invalid)} invalid entries."
+        await ctx.send(msg)
+
+    @automod.group(invoke_without_command=True)
+    @commands.has_permissions(administrator=True)
+    async def domains(self, ctx, verdict="block"):
+        """Displays the blocked or allowed domains list.
+
+        You must have the Administrator permission to use this.
+        """
+
+        if verdict not in ("block", "allow"):
+            return await ctx.send("The list must be either block or allow.")
+
+        key = f"{verdict}ed_domains"
+        data = await self.bot.mongo.db.guild.find_one({"_id": ctx.guild.id}, {key: 1})
+        pages = menus.MenuPages(
+            source=EmbedListPageSource(
+                [] if data is None else data.get(key, []),
+                title=f"{verdict.title()}ed Domains",
+                show_index=True,
+            )
+        )
+        await pages.start(ctx)
+
+    @domains.command()
+    @commands.has_permissions(administrator=True)
+    async def block(self, ctx, *domains):
+        """Adds domains or invites to the blocked domains list.
+
+        A domain also blocks its subdomains, while *.domain blocks only the subdomains.
+
+        You must have the Administrator permission to use this.
+        """
+
+        rules, invalid = self.parse_domain_rules(domains)
+        if len(rules) > 0:
+            await self.update_domains(ctx.guild, rules, "block")
+        await self.send_domain_update(ctx, rules, invalid, "Added {} to the blocked domains list.")
+
+    @domains.command()
+    @commands.has_permissions(administrator=True)
+    async def allow(self, ctx, *domains):
+        """Adds domains or invites to the allowed domains list.
+
+        Allowed domains override blocked domains that are less specific.
+
+        You must have the Administrator permission to use this.
+        """
+
+        rules, invalid = self.parse_domain_rules(domains)
+        if len(rules) > 0:
+            await self.update_domains(ctx.guild, rules, "allow")
+        await self.send_domain_update(ctx, rules, invalid, "Added {} to the allowed domains list.")
+
+    @domains.command(name="remove")
+    @commands.has_permissions(administrator=True)
+    async def domains_remove(self, ctx, *domains):
+        """Removes domains or invites from the blocked and allowed domains lists.
+
+        You must have the Administrator permission to use this.
+        """
+
+        rules, invalid = self.parse_domain_rules(domains)
+        if len(rules) > 0:
+            await self.update_domains(ctx.guild, rules, None)
+        await self.send_domain_update(ctx, rules, invalid, "Removed {} from the domains lists.")
+
+    @domains.command(name="import")
+    @commands.has_permissions(administrator=True)
+    async def domains_import(self, ctx, verdict="block"):
+        """Adds every domain in an attached text file to the blocked or allowed domains list.
+
+        The file should have one domain per line. Hosts files are also accepted.
+
+        You must have the Administrator permission to use this.
+        """
+
+        if verdict not in ("block", "allow"):
+            return await ctx.send("The list must be either block or allow.")
+        if len(ctx.message.attachments) == 0:
+            return await ctx.send("Please attach a file with one domain per line.")
+
+        data = await ctx.message.attachments[0].read()
+        lines = (x.split("#")[0].split() for x in data.decode("utf-8", "ignore").splitlines())
+        rules, invalid = self.parse_domain_rules([x[-1] for x in lines if len(x) > 0])
+        rules = list(dict.fromkeys(rules))
+        if len(rules) > 0:
+            await self.update_domains(ctx.guild, rules, verdict)
+        await self.send_domain_update(
+            ctx, rules, invalid, f"Added {{}} to the {verdict}ed domains list."
+        )
+
+    @automod.command()
+    @commands.has_permissions(administrator=True)
+    async def spam(self, ctx, kind, count: int = None, per: time.TimeDelta = None):
+        """Configures the flood and duplicate message limits.
+
+        The kind is either flood (messages per member) or duplicate (members sending the same
+        message). With no count, displays the current limit.
+
+        You must have the Administrator permission to use this.
+        """
+
+        if kind not in ("flood", "duplicate"):
+            return await ctx.send("The kind must be either flood or duplicate.")
+
+        if count is not None:
+            if count < 1:
+                return await ctx.send("The count must be at least 1.")
+            if per is not None and per.total_seconds() < 1:
+                return await ctx.send("The time period must be at least 1 second.")
+            kwargs = {f"{kind}_count": count}
+            if per is not None:
+                kwargs[f"{kind}_seconds"] = int(per.total_seconds())
+            await self.update_settings(ctx.guild, **kwargs)
+
+        config = await self.fetch_config(ctx.guild)
+        count, per = getattr(config, f"{kind}_count"), getattr(config, f"{kind}_seconds")
+        per = time.strfdelta(timedelta(seconds=per), long=True)
+        if kind == "flood":
+            await ctx.send(
+                f"Members are flagged for sending **{count}** messages within **{per}**."
+            )
+        else:
+            await ctx.send(
+                f"Messages are flagged once **{count}** members send the same one within **{per}**."
+            )
+
+    @automod.command()
+    @commands.has_permissions(administrator=True)
+    async def cache(self, ctx):
+        """Displays statistics for the automod cache.
+
+        You must have the Administrator permission to use this.
+        """
+
+        hits, misses = self.cache_stats["hits"], self.cache_stats["misses"]
+        rate = hits / (hits + misses) if hits + misses > 0 else 0
+
+        embed = discord.Embed(color=discord.Color.blurple(), title="Automod Cache")
+        embed.add_field(name="Hits", value=str(hits))
+        embed.add_field(name="Misses", value=str(misses))
+        embed.add_field(name="Hit Rate", value=f"{rate:.2%}")
+        embed.add_field(name="Invalidations", value=str(self.cache_stats["invalidations"]))
+        embed.add_field(name="Domain Updates", value=str(self.cache_stats["domain_updates"]))
+        embed.add_field(name="Cached Guilds", value=str(len(self.configs)))
+        await ctx.send(embed=embed)
+
+    def cog_unload(self):
+        self._listen_task.cancel()
+        self.bot.loop.create_task(self.bot.redis.unsubscribe("automod:invalidate"))
+
 
 def setup(bot):
     bot.add_cog(Automod(bot))
@@ -14,6 +14,7 @@ from typing import Counter
 import discord
 from discord.ext import commands, menus, tasks
 from helpers.constants import LETTER_REACTIONS
+from helpers.leaderboard import LeaderboardSnapshot, RankIndex
 from helpers.pagination import AsyncFieldsPageSource
 
 
@@ -31,8 +32,19 @@ class FoodTriviaEvent(commands.Cog):
             self.questions = json.load(f)
             self.questions = [x for x in self.questions if len(x["question"]) > 0]
             self.answers = {x["answer"] for x in self.questions}
+        self.ranks = RankIndex(bot, "food_trivia_points")
+        self.snapshot = LeaderboardSnapshot(
+            self.ranks,
+            self.format_leaderboard_item,
+            max_changes=getattr(bot.config, "LEADERBOARD_SNAPSHOT_CHANGES", 50),
+        )
+        self._rebuild_task = self.bot.loop.create_task(self.rebuild_ranks())
         self.start_game.start()
 
+    async def rebuild_ranks(self):
+        await self.bot.get_cog("Redis").wait_until_ready()
+        await self.ranks.rebuild()
+
     def get_question(self):
         question = random.choice(self.questions)
         question["choices"] = random.sample(self.answers - {question["answer"]}, 5)
@@ -109,6 +121,8 @@ class FoodTriviaEvent(commands.Cog):
                 await self.bot.mongo.db.member.update_one(
                     {"_id": user.id}, {"$inc": {"food_trivia_points": 1}}, upsert=True
                 )
+                await self.ranks.incr(user.id, 1)
+                self.snapshot.mark_changed()
                 users[user.id] += 1
 
         if len(users) == 0:
@@ -125,6 +139,8 @@ class FoodTriviaEvent(commands.Cog):
         await self.bot.mongo.db.member.update_one(
             {"_id": winner_id}, {"$inc": {"food_trivia_points": bonus}}, upsert=True
         )
+        await self.ranks.incr(winner_id, bonus)
+        self.snapshot.mark_changed()
 
     @start_game.before_loop
     async def before_start_game(self):
@@ -133,38 +149,40 @@ class FoodTriviaEvent(commands.Cog):
         await discord.utils.sleep_until(prev_half + timedelta(minutes=30))
         await self.bot.wait_until_ready()
 
+    def format_leaderboard_item(self, i, x):
+        name = f"{i + 1}. {x['name']}#{x['discriminator']}"
+        if x.get("nick") is not None:
+            name = f"{name} ({x['nick']})"
+        return {
+            "name": name,
+            "value": str(x.get("food_trivia_points", 0)),
+            "inline": False,
+        }
+
     @commands.command(aliases=("eventlb", "eventtop", "etop"))
     async def eventleaderboard(self, ctx):
         """Displays the leaderboard for the Food Trivia event."""
 
-        users = self.bot.mongo.db.member.find().sort("food_trivia_points", -1)
-        count = await self.bot.mongo.db.member.count_documents({})
+        await self.snapshot.refresh()
 
         def format_embed(embed):
             embed.set_thumbnail(url=ctx.guild.icon_url)
-
-        def format_item(i, x):
-            name = f"{i + 1}. {x['name']}#{x['discriminator']}"
-            if x.get("nick") is not None:
-                name = f"{name} ({x['nick']})"
-            return {
-                "name": name,
-                "value": str(x.get("food_trivia_points", 0)),
-                "inline": False,
-            }
+            embed.timestamp = self.snapshot.updated_at
 
         pages = menus.MenuPages(
             source=AsyncFieldsPageSource(
-                users,
+                self.snapshot.entries(),
                 title=f"Food Trivia Event Leaderboard",
                 format_embed=format_embed,
-                format_item=format_item,
-                count=count,
+                format_item=lambda i, x: x,
+                count=self.snapshot.count,
+                footer="Updated",
             )
         )
         await pages.start(ctx)
 
     def cog_unload(self):
+        self._rebuild_task.cancel()
         self.start_game.cancel()
 
 
@@ -5,10 +5,15 @@
 # Copyright (c) 2021 Oliver Ni
 
 import random
+import time
+from collections import Counter, defaultdict
 
 import discord
-from discord.ext import commands, menus
+from discord.ext import commands, menus, tasks
+from helpers.leaderboard import LeaderboardSnapshot, RankIndex
 from helpers.pagination import AsyncFieldsPageSource
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 
 
 class Levels(commands.Cog):
@@ -16,41 +21,122 @@ class Levels(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.totals = {}
+        self.pending = defaultdict(Counter)
+        self.ranks = RankIndex(bot, "xp")
+        self.snapshot = LeaderboardSnapshot(
+            self.ranks,
+            self.format_leaderboard_item,
+            max_changes=getattr(bot.config, "LEADERBOARD_SNAPSHOT_CHANGES", 50),
+        )
+        self._rebuild_task = self.bot.loop.create_task(self.rebuild_ranks())
+        self.flush_xp.add_exception_type(PyMongoError)
+        self.flush_xp.start()
 
     def min_xp_at(cls, level):
         return (2 * level * level + 27 * level + 91) * level * 5 // 6
 
+    def level_at(self, xp):
+        # min_xp_at is increasing, so binary search for the highest level below xp
+        lo, hi = 0, 1
+        while self.min_xp_at(hi) < xp:
+            hi *= 2
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.min_xp_at(mid) < xp:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    async def fetch_totals(self, user_id):
+        if user_id not in self.totals:
+            user = await self.bot.mongo.db.member.find_one({"_id": user_id}, {"xp": 1, "level": 1})
+            user = user or {}
+            self.totals[user_id] = {"xp": user.get("xp", 0), "level": user.get("level", 0)}
+        return self.totals[user_id]
+
+    async def rebuild_ranks(self):
+        await self.bot.get_cog("Redis").wait_until_ready()
+        await self.ranks.rebuild()
+        # Buffered totals are ahead of the database
+        for user_id, totals in list(self.totals.items()):
+            await self.ranks.set(user_id, totals["xp"])
+
+    async def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        pending, self.pending = self.pending, defaultdict(Counter)
+        user_ids = list(pending)
+        ops = [
+            UpdateOne(
+                {"_id": user_id},
+                {"$inc": dict(pending[user_id]), "$max": {"level": self.totals[user_id]["level"]}},
+                upsert=True,
+            )
+            for user_id in user_ids
+        ]
+
+        try:
+            await self.bot.mongo.db.member.bulk_write(ops, ordered=False)
+        except BulkWriteError as error:
+            # Only requeue the ops that failed, the rest were applied
+            failed = {user_ids[x["index"]] for x in error.details["writeErrors"]}
+            self.requeue(pending, failed)
+            self.forget_totals(x for x in user_ids if x not in failed)
+            raise
+        except Exception:
+            self.requeue(pending, user_ids)
+            raise
+        self.forget_totals(user_ids)
+
+    def requeue(self, pending, user_ids):
+        for user_id in user_ids:
+            self.pending[user_id].update(pending[user_id])
+
+    def forget_totals(self, user_ids):
+        # Written totals are reloaded on the next message, which picks up changes made
+        # elsewhere and keeps the cache to recently active members
+        for user_id in user_ids:
+            if user_id not in self.pending:
+                self.totals.pop(user_id, None)
+
+    @tasks.loop(minutes=10)
+    async def flush_xp(self):
+        await self.flush()
+
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.guild is None or message.author.bot:
             return
 
         # Set 60s timeout between messages
-        if await self.bot.redis.get(f"xp:{message.author.id}") is not None:
+        key = f"xp:{message.author.id}"
+        if not await self.bot.redis.set(key, 1, expire=60, exist=self.bot.redis.SET_IF_NOT_EXIST):
             return
-        await self.bot.redis.set(f"xp:{message.author.id}", 1, expire=60)
 
+        # Increments are buffered and written to the database by flush_xp
         xp = random.randint(15, 25)
-        user = await self.bot.mongo.db.member.find_one_and_update(
-            {"_id": message.author.id}, {"$inc": {"messages": 1, "xp": xp}}
-        )
-
-        if user.get("xp", 0) + xp > self.min_xp_at(user.get("level", 0) + 1):
-            await self.bot.mongo.db.member.update_one({"_id": message.author.id}, {"$inc": {"level": 1}})
-            msg = (
-                f"Congratulations {message.author.mention}, you are now level **{user.get('level', 0) + 1}**!"
-            )
+        totals = await self.fetch_totals(message.author.id)
+        totals["xp"] += xp
+        self.pending[message.author.id].update(messages=1, xp=xp)
+        await self.ranks.set(message.author.id, totals["xp"])
+        self.snapshot.mark_changed()
+
+        level = self.level_at(totals["xp"])
+        if level > totals["level"]:
+            totals["level"] = level
+            msg = f"Congratulations {message.author.mention}, you are now level **{totals['level']}**!"
             await message.channel.send(msg)
 
     @commands.command(aliases=("rank", "level"))
     async def xp(self, ctx):
         """Shows your server XP and level."""
 
-        user = await self.bot.mongo.db.member.find_one({"_id": ctx.author.id})
-        rank = await self.bot.mongo.db.member.count_documents(
-            {"xp": {"$gt": user.get("xp", 0)}, "_id": {"$ne": ctx.author.id}}
-        )
-        xp, level = user.get("xp", 0), user.get("level", 0)
+        user = await self.fetch_totals(ctx.author.id)
+        rank = await self.ranks.rank(user["xp"])
+        xp, level = user["xp"], user["level"]
         progress = xp - self.min_xp_at(level)
         required = self.min_xp_at(level + 1) - self.min_xp_at(level)
 
@@ -59,40 +145,90 @@ class Levels(commands.Cog):
         embed.title = f"Level {level}"
         embed.add_field(name="XP", value=str(xp))
         embed.add_field(name="Progress", value=f"{progress}/{required}")
-        embed.add_field(name="Rank", value=str(rank + 1))
+        embed.add_field(name="Rank", value=str(rank))
         await ctx.send(embed=embed)
 
+    async def recompute_levels(self, batch_size=1000):
+        await self.flush()
+
+        checked, corrected, ops = 0, 0, []
+        users = self.bot.mongo.db.member.find({}, {"xp": 1, "level": 1}, batch_size=batch_size)
+        async for user in users:
+            checked += 1
+            level = self.level_at(user.get("xp", 0))
+            if level != user.get("level", 0):
+                # Match on xp as well, so members who gained XP meanwhile are left alone
+                ops.append(
+                    UpdateOne(
+                        {"_id": user["_id"], "xp": user.get("xp", 0)}, {"$set": {"level": level}}
+                    )
+                )
+            if len(ops) >= batch_size:
+                result = await self.bot.mongo.db.member.bulk_write(ops, ordered=False)
+                corrected += result.modified_count
+                ops = []
+        if len(ops) > 0:
+            result = await self.bot.mongo.db.member.bulk_write(ops, ordered=False)
+            corrected += result.modified_count
+
+        for totals in self.totals.values():
+            totals["level"] = self.level_at(totals["xp"])
+
+        return checked, corrected
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def recomputelevels(self, ctx):
+        """Recomputes every member's level from their XP.
+
+        You must have the Administrator permission to use this.
+        """
+
+        await ctx.send("Recomputing levels, this may take a while...")
+        start = time.perf_counter()
+        checked, corrected = await self.recompute_levels()
+        seconds = time.perf_counter() - start
+        await ctx.send(
+            f"Checked **{checked}** members and corrected **{corrected}** levels in **{seconds:.1f}s**."
+        )
+
+    def format_leaderboard_item(self, i, x):
+        name = f"{i + 1}. {x['name']}#{x['discriminator']}"
+        if x.get("nick") is not None:
+            name = f"{name} ({x['nick']})"
+        return {
+            "name": name,
+            "value": f"{x.get('xp', 0)} (Level {self.level_at(x.get('xp', 0))})",
+            "inline": False,
+        }
+
     @commands.command(aliases=("top", "lb", "levels"))
     async def leaderboard(self, ctx):
         """Displays the server XP leaderboard."""
 
-        users = self.bot.mongo.db.member.find().sort("xp", -1)
-        count = await self.bot.mongo.db.member.count_documents({})
+        await self.snapshot.refresh()
 
         def format_embed(embed):
             embed.set_thumbnail(url=ctx.guild.icon_url)
-
-        def format_item(i, x):
-            name = f"{i + 1}. {x['name']}#{x['discriminator']}"
-            if x.get("nick") is not None:
-                name = f"{name} ({x['nick']})"
-            return {
-                "name": name,
-                "value": f"{x.get('xp', 0)} (Level {x.get('level', 0)})",
-                "inline": False,
-            }
+            embed.timestamp = self.snapshot.updated_at
 
         pages = menus.MenuPages(
             source=AsyncFieldsPageSource(
-                users,
+                self.snapshot.entries(),
                 title=f"XP Leaderboard",
                 format_embed=format_embed,
-                format_item=format_item,
-                count=count,
+                format_item=lambda i, x: x,
+                count=self.snapshot.count,
+                footer="Updated",
             )
         )
         await pages.start(ctx)
 
+    def cog_unload(self):
+        self._rebuild_task.cancel()
+        self.flush_xp.cancel()
+        self.bot.loop.create_task(self.flush())
+
 
 def setup(bot):
     bot.add_cog(Levels(bot))
@@ -4,14 +4,49 @@
 
 # Copyright (c) 2021 Oliver Ni
 
+import asyncio
 import logging
-from datetime import datetime, timezone
+import multiprocessing
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import discord
-from discord.ext import commands
+from dateutil.parser import parse
+from discord.ext import commands, ipc, menus, tasks
+from helpers.archive import (
+    MessageCodec,
+    append_ndjson,
+    archive_collection_name,
+    content_key,
+    diff_content,
+    message_versions,
+    snowflake_range,
+    train_dictionary,
+)
+from helpers.attachments import AttachmentArchiver
+from helpers.batching import BatchWriter
+from helpers.logfiles import QueueLogging, expire_rotated, rotating_file_handler
+from helpers.pagination import AsyncFieldsPageSource
+from helpers.search import (
+    SearchIndex,
+    append_changes,
+    compact_index,
+    journal_size,
+    load_index,
+    rotate_journal,
+)
+from helpers.sync import FieldCache
+from helpers.utils import FetchUserConverter
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
 formatter = logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
 
+KEYFRAME_INTERVAL = 10
+MAX_TRACKED_EDITS = 10000
+
 
 class Logging(commands.Cog):
     """For logging."""
@@ -20,18 +55,421 @@ class Logging(commands.Cog):
         self.bot = bot
 
         self.log = logging.getLogger(f"Support")
-        handler = logging.FileHandler(f"logs/support.log")
-        handler.setFormatter(formatter)
-        self.log.handlers = [handler]
-
         dlog = logging.getLogger("discord")
-        dhandler = logging.FileHandler(f"logs/discord.log")
-        dhandler.setFormatter(formatter)
-        dlog.handlers = [dhandler]
+
+        self.log_files = QueueLogging()
+        for logger, path in ((self.log, "logs/support.log"), (dlog, "logs/discord.log")):
+            handler = rotating_file_handler(
+                path,
+                max_bytes=getattr(bot.config, "LOG_MAX_BYTES", 50 * 2 ** 20),
+                when=getattr(bot.config, "LOG_ROTATE_WHEN", None),
+                backup_count=getattr(bot.config, "LOG_BACKUP_COUNT", 10),
+                compress=getattr(bot.config, "LOG_COMPRESS", False),
+            )
+            handler.setFormatter(formatter)
+            self.log_files.attach(logger, handler)
 
         self.log.setLevel(logging.DEBUG)
         dlog.setLevel(logging.INFO)
 
+        self.compressed = getattr(bot.config, "MESSAGE_ARCHIVE_MODE", "raw") == "compressed"
+        self.codec = MessageCodec()
+        self._load_task = self.bot.loop.create_task(self.load_dictionaries())
+        self._reconcile_task = self.bot.loop.create_task(self.reconcile_all())
+        self.edit_counts = OrderedDict()
+        self.synced = FieldCache()
+        self.indexed = set()
+
+        self.search_path = getattr(bot.config, "SEARCH_INDEX_PATH", "search/messages.idx")
+        self.search_index = SearchIndex()
+        self.search_ready = False
+        self.search_lock = asyncio.Lock()
+        self.search_journal_max = getattr(bot.config, "SEARCH_JOURNAL_MAX_BYTES", 64 * 2 ** 20)
+        self.compactor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"))
+        self._search_task = self.bot.loop.create_task(self.load_search_index())
+        self.save_search_index.start()
+
+        self.retention_task.add_exception_type(PyMongoError)
+        self.retention_task.start()
+
+        self.writer = BatchWriter(self.write_messages)
+        self.writer.start(self.bot.loop)
+
+        quota = getattr(bot.config, "ATTACHMENT_QUOTA", 10 * 2 ** 30)
+        self.attachments = AttachmentArchiver(bot, quota=quota)
+
+    async def load_dictionaries(self, versions=None):
+        query = {} if versions is None else {"_id": {"$in": list(versions)}}
+        async for x in self.bot.mongo.db.archive_dictionary.find(query).sort("_id", 1):
+            self.codec.add_dictionary(x["_id"], x["data"])
+            if x["_id"] > self.codec.version:
+                self.codec.use_dictionary(x["_id"])
+
+    async def load_missing_dictionaries(self, docs):
+        # Dictionaries may have been trained by another process since we loaded ours
+        values = []
+        for doc in docs:
+            values.extend(doc["history"].values())
+            values.extend(x["c"] for x in doc.get("edits", []) if "c" in x)
+        versions = self.codec.missing_versions(values)
+        if len(versions) > 0:
+            await self.load_dictionaries(versions)
+
+    # Search index
+
+    def index_message(self, doc):
+        # Decode a copy, since the document may still be waiting in the writer
+        doc = self.decode_message({**doc, "edits": [dict(x) for x in doc.get("edits", [])]})
+        versions = doc["versions"]
+        if len(versions) > 0:
+            self.search_index.add(doc["_id"], doc["channel_id"], doc["user_id"], versions[0][1])
+        for _, content in versions[1:]:
+            self.search_index.add_edit(doc["_id"], content)
+        if doc.get("deleted_at") is not None:
+            self.search_index.delete([doc["_id"]])
+
+    async def load_search_index(self):
+        index = await self.bot.loop.run_in_executor(None, load_index, self.search_path)
+
+        # Messages seen while loading went to the old index, but are in the archive or
+        # still waiting in the writer, so catch up from both.
+        self.search_index = index
+        for doc in [*self.writer.inflight.values(), *self.writer.pending.values()]:
+            self.index_message(doc)
+
+        names = await self.archive_collection_names(after=index.last_id)
+        if self.compressed:
+            names.append("message")
+        for name in names:
+            query = {"_id": {"$gt": index.last_id}}
+            async for doc in self.bot.mongo.db[name].find(query).sort("_id", 1):
+                await self.load_missing_dictionaries([doc])
+                self.index_message(doc)
+        self.search_ready = True
+
+    async def write_search_index(self, compact=True):
+        """Appends changes to the journal, and compacts it in another process once large."""
+
+        if not self.search_ready:
+            return
+
+        loop, path = self.bot.loop, self.search_path
+        async with self.search_lock:
+            changes = self.search_index.take_changes()
+            if len(changes) > 0:
+                try:
+                    await loop.run_in_executor(None, append_changes, path, changes)
+                except Exception:
+                    self.search_index.changes[:0] = changes
+                    raise
+
+            if not compact:
+                return
+            if await loop.run_in_executor(None, journal_size, path) < self.search_journal_max:
+                return
+            await loop.run_in_executor(None, rotate_journal, path)
+
+        await loop.run_in_executor(self.compactor, compact_index, path)
+
+    @tasks.loop(minutes=5)
+    async def save_search_index(self):
+        await self.write_search_index()
+
+    # Retention
+
+    async def retention_overrides(self):
+        """Returns {channel_id: days} for channels that don't use the default retention.
+
+        0 days means messages are kept forever.
+        """
+
+        restricted_days = getattr(self.bot.config, "RESTRICTED_MESSAGE_RETENTION_DAYS", None)
+        query = {"$or": [{"retention_days": {"$exists": True}}, {"restricted": True}]}
+        overrides = {}
+        async for x in self.bot.mongo.db.channel.find(query):
+            days = x.get("retention_days", restricted_days)
+            if days is not None:
+                overrides[x["_id"]] = days
+        return overrides
+
+    async def expire_messages(self, query, batch_size=1000):
+        """Exports matching messages to cold storage, then deletes them in batches."""
+
+        stamp = f"{datetime.utcnow():%Y%m%d-%H%M%S}"
+        cold_path = getattr(self.bot.config, "COLD_ARCHIVE_PATH", "cold")
+
+        names = await self.archive_collection_names(before=query["_id"]["$lt"])
+        if self.compressed:
+            names.append("message")
+
+        count = 0
+        for name in names:
+            path = f"{cold_path}/{name}/{stamp}.ndjson.gz"
+            collection = self.bot.mongo.db[name]
+            while True:
+                # Always read from the start, since each batch is deleted once written
+                cursor = collection.find(query).sort("_id", 1).limit(batch_size)
+                batch = await self.decode_messages(await cursor.to_list(None))
+                if len(batch) == 0:
+                    break
+                await self.bot.loop.run_in_executor(None, append_ndjson, path, batch)
+                ids = [x["_id"] for x in batch]
+                await collection.delete_many({"_id": {"$in": ids}})
+                await self.bot.mongo.db.attachment.delete_many({"message_id": {"$in": ids}})
+                count += len(batch)
+        return count
+
+    async def apply_retention(self):
+        now = datetime.utcnow()
+        counts = Counter()
+
+        default_days = getattr(self.bot.config, "MESSAGE_RETENTION_DAYS", 0)
+        overrides = await self.retention_overrides()
+        for channel_id, days in overrides.items():
+            if days > 0:
+                _, before = snowflake_range(end=now - timedelta(days=days))
+                query = {"channel_id": channel_id, "_id": {"$lt": before}}
+                counts["messages"] += await self.expire_messages(query)
+        if default_days > 0:
+            _, before = snowflake_range(end=now - timedelta(days=default_days))
+            query = {"channel_id": {"$nin": list(overrides)}, "_id": {"$lt": before}}
+            counts["messages"] += await self.expire_messages(query)
+
+        attachment_days = getattr(self.bot.config, "ATTACHMENT_RETENTION_DAYS", 0)
+        if attachment_days > 0:
+            before = now - timedelta(days=attachment_days)
+            counts["attachments"] = await self.attachments.expire(before)
+
+        log_days = getattr(self.bot.config, "LOG_RETENTION_DAYS", 0)
+        if log_days > 0:
+            before = (now - timedelta(days=log_days)).replace(tzinfo=timezone.utc).timestamp()
+            counts["log files"] = expire_rotated("logs", before)
+
+        self.log.info(f"Applied retention: {dict(counts)}")
+        return counts
+
+    @tasks.loop(hours=24)
+    async def retention_task(self):
+        await self.bot.wait_until_ready()
+        await self.apply_retention()
+
+    # Message archive
+
+    def message_collection_name(self, message_id):
+        return archive_collection_name(message_id) if self.compressed else "message"
+
+    def message_collection(self, message_id):
+        return self.bot.mongo.db[self.message_collection_name(message_id)]
+
+    def encode_content(self, content):
+        return self.codec.compress(content) if self.compressed else content
+
+    def decode_message(self, doc):
+        doc["history"] = {k: self.codec.decompress(v) for k, v in doc["history"].items()}
+        for edit in doc.get("edits", []):
+            if "c" in edit:
+                edit["c"] = self.codec.decompress(edit["c"])
+        doc["versions"] = list(message_versions(doc))
+        return doc
+
+    async def decode_messages(self, docs):
+        await self.load_missing_dictionaries(docs)
+        return [self.decode_message(x) for x in docs]
+
+    def track_deltas(self, message_id, count):
+        self.edit_counts.pop(message_id, None)
+        self.edit_counts[message_id] = count
+        if len(self.edit_counts) > MAX_TRACKED_EDITS:
+            self.edit_counts.popitem(last=False)
+
+    def encode_edit(self, payload, time):
+        content = payload.data["content"]
+
+        # Each message gets a full keyframe every so often, and whenever the previous
+        # version isn't known, so a missed edit can't corrupt every later version.
+        count = self.edit_counts.get(payload.message_id)
+        if payload.cached_message is not None and count is not None and count < KEYFRAME_INTERVAL:
+            base = payload.cached_message.content
+            delta = diff_content(base, content)
+            if sum(len(x[2]) + 8 for x in delta) < len(content):
+                self.track_deltas(payload.message_id, count + 1)
+                return {"t": time, "d": delta, "b": list(content_key(base))}
+
+        self.track_deltas(payload.message_id, 0)
+        return {"t": time, "c": self.encode_content(content)}
+
+    async def fetch_message(self, message_id):
+        doc = await self.message_collection(message_id).find_one({"_id": message_id})
+        if doc is None and self.compressed:
+            doc = await self.bot.mongo.db.message.find_one({"_id": message_id})
+        if doc is None:
+            return None
+        (doc,) = await self.decode_messages([doc])
+        return doc
+
+    async def ensure_indexes(self, name):
+        if name in self.indexed:
+            return
+        await self.bot.mongo.db[name].create_index([("channel_id", 1), ("_id", 1)])
+        self.indexed.add(name)
+
+    async def archive_collection_names(self, after=None, before=None):
+        """Returns the archive collections that can hold IDs in (after, before), in ID order."""
+
+        if not self.compressed:
+            return ["message"]
+        names = await self.bot.mongo.db.list_collection_names(
+            filter={"name": {"$regex": r"^message_\d{4}_\d{2}$"}}
+        )
+        low = None if after is None else archive_collection_name(after)
+        high = None if before is None else archive_collection_name(before)
+        return sorted(x for x in names if (low is None or x >= low) and (high is None or x <= high))
+
+    async def query_messages(
+        self, channel_id, after=None, before=None, limit=50, newest_first=True, **filters
+    ):
+        """Returns up to limit archived messages in a channel with IDs in (after, before).
+
+        Each collection is scanned by ID range on its (channel_id, _id) index. To page,
+        pass the ID of the last message returned as before, or as after if not
+        newest_first. Any other filters are added to the query as-is.
+        """
+
+        query = {"channel_id": channel_id, **filters}
+        if after is not None or before is not None:
+            query["_id"] = {}
+        if after is not None:
+            query["_id"]["$gt"] = after
+        if before is not None:
+            query["_id"]["$lt"] = before
+        direction = -1 if newest_first else 1
+
+        async def scan(name, limit):
+            await self.ensure_indexes(name)
+            cursor = self.bot.mongo.db[name].find(query).sort("_id", direction).limit(limit)
+            return await cursor.to_list(None)
+
+        # Monthly collections don't overlap, so they can be read in order until full
+        names = await self.archive_collection_names(after, before)
+        docs = []
+        for name in reversed(names) if newest_first else names:
+            docs.extend(await scan(name, limit - len(docs)))
+            if len(docs) >= limit:
+                break
+
+        # Messages from before the archive was compressed may not be migrated yet
+        if self.compressed:
+            legacy = await scan("message", limit)
+            if len(legacy) > 0:
+                docs = sorted(docs + legacy, key=lambda x: x["_id"], reverse=newest_first)
+                docs = docs[:limit]
+
+        return await self.decode_messages(docs)
+
+    async def iter_messages(self, channel_id, after=None, before=None, page_size=50, **kwargs):
+        """Yields archived messages in a channel from newest to oldest, a page at a time."""
+
+        while True:
+            page = await self.query_messages(
+                channel_id, after=after, before=before, limit=page_size, **kwargs
+            )
+            for doc in page:
+                yield doc
+            if len(page) < page_size:
+                return
+            before = page[-1]["_id"]
+
+    @ipc.server.route()
+    async def channel_logs(self, data):
+        """Returns a page of a channel's archived messages for the logs site.
+
+        Bounds are given either as snowflakes (after, before) or as ISO 8601 times (start,
+        end). The returned cursor is passed back as before to get the next page.
+        """
+
+        after, before = getattr(data, "after", None), getattr(data, "before", None)
+        start, end = getattr(data, "start", None), getattr(data, "end", None)
+        if start is not None or end is not None:
+            after, before = snowflake_range(
+                start and datetime.fromisoformat(start), end and datetime.fromisoformat(end)
+            )
+
+        limit = min(getattr(data, "limit", 100), 500)
+        docs = await self.query_messages(data.channel_id, after=after, before=before, limit=limit)
+        messages = [
+            {
+                "id": x["_id"],
+                "user_id": x["user_id"],
+                "versions": x["versions"],
+                "attachments": x["attachments"],
+                "deleted_at": x["deleted_at"] and x["deleted_at"].isoformat(),
+            }
+            for x in docs
+        ]
+        cursor = docs[-1]["_id"] if len(docs) == limit else None
+        return {"messages": messages, "cursor": cursor}
+
+    async def get_buffered_message(self, message_id):
+        """Returns the document for a message if it is still buffered in the writer.
+
+        If the message is part of a write in progress, this waits for it, since a failed
+        write puts the document back in the buffer.
+        """
+
+        doc = self.writer.get(message_id)
+        if doc is None:
+            await self.writer.wait_written([message_id])
+            doc = self.writer.get(message_id)
+        return doc
+
+    async def update_messages(self, message_ids, update):
+        groups = defaultdict(list)
+        for message_id in message_ids:
+            groups[self.message_collection_name(message_id)].append(message_id)
+
+        matched = 0
+        for name, ids in groups.items():
+            result = await self.bot.mongo.db[name].update_many({"_id": {"$in": ids}}, update)
+            matched += result.matched_count
+
+        # Messages from before the archive was compressed may not be migrated yet
+        if self.compressed and matched < len(message_ids):
+            await self.bot.mongo.db.message.update_many({"_id": {"$in": list(message_ids)}}, update)
+
+    async def insert_messages(self, docs):
+        groups = defaultdict(list)
+        for doc in docs:
+            groups[self.message_collection_name(doc["_id"])].append(doc)
+
+        for name, group in groups.items():
+            await self.ensure_indexes(name)
+            try:
+                await self.bot.mongo.db[name].insert_many(group, ordered=False)
+            except BulkWriteError as error:
+                # Duplicates are left over from a retried batch
+                if any(x["code"] != 11000 for x in error.details["writeErrors"]):
+                    raise
+
+    async def write_messages(self, docs):
+        await self.insert_messages(docs)
+
+        last_message_ids = {}
+        for doc in docs:
+            channel_id = doc["channel_id"]
+            last_message_ids[channel_id] = max(last_message_ids.get(channel_id, 0), doc["_id"])
+        ops = [
+            UpdateOne({"_id": k}, {"$max": {"last_message_id": v}})
+            for k, v in last_message_ids.items()
+        ]
+        await self.bot.mongo.db.channel.bulk_write(ops, ordered=False)
+
+    async def flush(self):
+        await self.writer.close()
+        await self.attachments.close()
+        await self.write_search_index(compact=False)
+        self.compactor.shutdown(wait=False)
+        self.log_files.stop()
+
     def serialize_role(self, role):
         return {
             "id": role.id,
@@ -40,20 +478,14 @@ class Logging(commands.Cog):
             "position": role.position,
         }
 
-    async def sync_guild(self, guild):
-        await self.bot.mongo.db.guild.update_one(
-            {"_id": guild.id},
-            {
-                "$set": {
-                    "name": guild.name,
-                    "icon": str(guild.icon_url),
-                    "roles": [self.serialize_role(x) for x in guild.roles],
-                }
-            },
-            upsert=True,
-        )
+    def serialize_guild(self, guild):
+        return {
+            "name": guild.name,
+            "icon": str(guild.icon_url),
+            "roles": [self.serialize_role(x) for x in guild.roles],
+        }
 
-    async def sync_channel(self, channel):
+    def serialize_channel(self, channel):
         base = {
             "guild_id": channel.guild.id,
             "type": str(channel.type),
@@ -64,28 +496,89 @@ class Logging(commands.Cog):
             base["category_id"] = channel.category_id
         if isinstance(channel, discord.TextChannel):
             base["last_message_id"] = channel.last_message_id
+        return base
 
-        await self.bot.mongo.db.channel.update_one({"_id": channel.id}, {"$set": base}, upsert=True)
+    def serialize_member(self, member):
+        return {
+            "name": member.name,
+            "discriminator": member.discriminator,
+            "nick": member.nick,
+            "avatar": str(member.avatar_url),
+            "roles": [x.id for x in member.roles],
+        }
 
-    async def sync_member(self, member):
-        await self.bot.mongo.db.member.update_one(
-            {"_id": member.id},
-            {
-                "$set": {
-                    "name": member.name,
-                    "discriminator": member.discriminator,
-                    "nick": member.nick,
-                    "avatar": str(member.avatar_url),
-                    "roles": [x.id for x in member.roles],
-                }
-            },
-            upsert=True,
+    async def sync_fields(self, collection, id, fields):
+        # Most updates (presences, typing, etc.) don't touch anything we store
+        key = (collection, id)
+        changed = self.synced.changes(key, fields)
+        if len(changed) == 0:
+            return
+        await self.bot.mongo.db[collection].update_one({"_id": id}, {"$set": changed}, upsert=True)
+        self.synced.commit(key, changed)
+
+    async def reconcile_guild(self, guild, chunk_size=1000, progress=None):
+        """Writes every changed guild, channel and member document for a guild in bulk.
+
+        progress, if given, is awaited with (done, total) after each chunk. Returns the
+        number of documents written and the number checked.
+        """
+
+        if not guild.chunked:
+            await guild.chunk()
+
+        entities = [("guild", guild.id, self.serialize_guild(guild))]
+        entities.extend(("channel", x.id, self.serialize_channel(x)) for x in guild.channels)
+        entities.extend(("member", x.id, self.serialize_member(x)) for x in guild.members)
+
+        written = 0
+        for i in range(0, len(entities), chunk_size):
+            ops, changes = defaultdict(list), []
+            for collection, id, fields in entities[i : i + chunk_size]:
+                changed = self.synced.changes((collection, id), fields)
+                if len(changed) > 0:
+                    ops[collection].append(UpdateOne({"_id": id}, {"$set": changed}, upsert=True))
+                    changes.append(((collection, id), changed))
+
+            for collection, group in ops.items():
+                await self.bot.mongo.db[collection].bulk_write(group, ordered=False)
+            for key, changed in changes:
+                self.synced.commit(key, changed)
+
+            written += len(changes)
+            if progress is not None:
+                await progress(min(i + chunk_size, len(entities)), len(entities))
+
+        channel_ids = [x.id for x in guild.channels]
+        await self.bot.mongo.db.channel.delete_many(
+            {"guild_id": guild.id, "_id": {"$nin": channel_ids}}
+        )
+        return written, len(entities)
+
+    async def reconcile_logged(self, guild):
+        start = time.perf_counter()
+        written, total = await self.reconcile_guild(guild)
+        duration = time.perf_counter() - start
+        self.log.info(
+            f"Reconciled guild {guild.id}: wrote {written}/{total} documents in {duration:.2f}s"
         )
 
-    @commands.Cog.listener(name="on_guild_join")
-    @commands.Cog.listener(name="on_guild_update")
-    async def on_guild_updates(self, *args):
-        await self.sync_guild(args[-1])
+    async def reconcile_all(self):
+        await self.bot.wait_until_ready()
+        for guild in self.bot.guilds:
+            await self.reconcile_logged(guild)
+
+    async def sync_guild(self, guild):
+        await self.sync_fields("guild", guild.id, self.serialize_guild(guild))
+
+    async def sync_channel(self, channel):
+        await self.sync_fields("channel", channel.id, self.serialize_channel(channel))
+
+    async def sync_member(self, member):
+        await self.sync_fields("member", member.id, self.serialize_member(member))
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before, after):
+        await self.sync_guild(after)
 
     @commands.Cog.listener(name="on_member_join")
     @commands.Cog.listener(name="on_member_update")
@@ -95,12 +588,13 @@ class Logging(commands.Cog):
         if isinstance(thing, discord.User):
             guild = self.bot.get_guild(self.bot.config.GUILD_ID)
             thing = guild.get_member(thing.id)
+            if thing is None:
+                return
         await self.sync_member(thing)
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        for channel in guild.channels:
-            await self.sync_channel(channel)
+        await self.reconcile_logged(guild)
 
     @commands.Cog.listener(name="on_guild_channel_create")
     @commands.Cog.listener(name="on_guild_channel_update")
@@ -110,19 +604,20 @@ class Logging(commands.Cog):
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
         await self.bot.mongo.db.channel.delete_one({"_id": channel.id})
+        self.synced.forget(("channel", channel.id))
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.guild is None:
             return
         time = int(message.created_at.replace(tzinfo=timezone.utc).timestamp() - 3600)
-        await self.bot.mongo.db.message.insert_one(
+        await self.writer.put(
             {
                 "_id": message.id,
                 "user_id": message.author.id,
                 "channel_id": message.channel.id,
                 "guild_id": message.guild.id,
-                "history": {str(time): message.content},
+                "history": {str(time): self.encode_content(message.content)},
                 "attachments": [
                     {"id": attachment.id, "filename": attachment.filename}
                     for attachment in message.attachments
@@ -130,37 +625,68 @@ class Logging(commands.Cog):
                 "deleted_at": None,
             }
         )
-        await self.bot.mongo.db.channel.update_one(
-            {"_id": message.channel.id}, {"$set": {"last_message_id": message.id}}
-        )
+        self.track_deltas(message.id, 0)
+        self.attachments.enqueue(message)
+        self.search_index.add(message.id, message.channel.id, message.author.id, message.content)
 
     @commands.Cog.listener()
     async def on_raw_message_edit(self, payload):
         if "content" not in payload.data:
             return
+        cached = payload.cached_message
+        if cached is not None and cached.content == payload.data["content"]:
+            return
         time = int(datetime.now().timestamp()) - 3600
-        await self.bot.mongo.db.message.update_one(
-            {"_id": payload.message_id},
-            {"$set": {f"history.{time}": payload.data["content"]}},
-        )
+        self.search_index.add_edit(payload.message_id, payload.data["content"])
+
+        # The message may not have been written yet
+        edit = self.encode_edit(payload, time)
+        doc = await self.get_buffered_message(payload.message_id)
+        if doc is not None:
+            doc.setdefault("edits", []).append(edit)
+            return
+
+        try:
+            await self.update_messages([payload.message_id], {"$push": {"edits": edit}})
+        except Exception:
+            # Later deltas would be based on the lost version, so start from a keyframe
+            self.edit_counts.pop(payload.message_id, None)
+            raise
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
-        if payload.cached_message is not None:
-            for attachment in payload.cached_message.attachments:
-                fn = f"attachments/{attachment.id}_{attachment.filename}"
-                self.bot.loop.create_task(attachment.save(fn, use_cached=True))
-        await self.bot.mongo.db.message.update_one(
-            {"_id": payload.message_id},
-            {"$set": {"deleted_at": datetime.utcnow()}},
-        )
+        await self.attachments.mark_deleted([payload.message_id])
+        self.search_index.delete([payload.message_id])
+
+        doc = await self.get_buffered_message(payload.message_id)
+        if doc is not None:
+            doc["deleted_at"] = datetime.utcnow()
+            return
+
+        update = {"$set": {"deleted_at": datetime.utcnow()}}
+        await self.update_messages([payload.message_id], update)
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload):
-        await self.bot.mongo.db.message.update_many(
-            {"_id": {"$in": list(payload.message_ids)}},
-            {"$set": {"deleted_at": datetime.utcnow()}},
-        )
+        await self.attachments.mark_deleted(payload.message_ids)
+        self.search_index.delete(payload.message_ids)
+
+        for message_id in payload.message_ids:
+            doc = self.writer.get(message_id)
+            if doc is not None:
+                doc["deleted_at"] = datetime.utcnow()
+        await self.writer.wait_written(payload.message_ids)
+
+        # Documents from a failed write are back in the buffer, where an update wouldn't see them
+        written = []
+        for message_id in payload.message_ids:
+            doc = self.writer.get(message_id)
+            if doc is not None:
+                doc["deleted_at"] = datetime.utcnow()
+            else:
+                written.append(message_id)
+        if len(written) > 0:
+            await self.update_messages(written, {"$set": {"deleted_at": datetime.utcnow()}})
 
     @commands.group(invoke_without_command=True)
     @commands.has_permissions(manage_messages=True)
@@ -185,6 +711,259 @@ class Logging(commands.Cog):
         await self.bot.mongo.db.channel.update_one({"_id": channel.id}, {"$set": {"restricted": True}})
         await ctx.send(f"Restricted logs for **#{channel}** to Admins.")
 
+    @logs.command()
+    @commands.has_permissions(administrator=True)
+    async def retention(self, ctx, channel: discord.TextChannel, days):
+        """Sets how many days of logs to keep for a channel, or "forever" or "default".
+
+        You must have the Administrator permission to use this.
+        """
+
+        if days == "default":
+            update = {"$unset": {"retention_days": 1}}
+            message = f"Logs for **#{channel}** now use the default retention."
+        else:
+            try:
+                days = 0 if days == "forever" else int(days)
+            except ValueError:
+                return await ctx.send("Please enter a number of days, forever or default.")
+            if days < 0:
+                return await ctx.send("Please enter a number of days, forever or default.")
+            update = {"$set": {"retention_days": days}}
+            kept = "forever" if days == 0 else f"for {days} days"
+            message = f"Logs for **#{channel}** will now be kept {kept}."
+
+        await self.bot.mongo.db.channel.update_one({"_id": channel.id}, update)
+        await ctx.send(message)
+
+    @logs.command()
+    @commands.has_permissions(administrator=True)
+    async def expire(self, ctx):
+        """Applies the retention policy now, instead of waiting for the daily run.
+
+        You must have the Administrator permission to use this.
+        """
+
+        message = await ctx.send("Applying retention policy...")
+        counts = await self.apply_retention()
+        removed = ", ".join(f"{v} {k}" for k, v in counts.items()) or "nothing"
+        await message.edit(content=f"Removed {removed}.")
+
+    @logs.command()
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx):
+        """Displays statistics for the message log writer and attachment mirror.
+
+        You must have the Administrator permission to use this.
+        """
+
+        writer, stats = self.writer, self.writer.stats
+        write_ms = stats["write_ms"] / max(stats["batches"], 1)
+
+        embed = discord.Embed(color=discord.Color.blurple(), title="Message Log Writer")
+        embed.add_field(name="Pending", value=f"{len(writer.pending)}/{writer.max_pending}")
+        embed.add_field(name="Max Pending", value=str(stats["max_pending"]))
+        embed.add_field(name="Queued", value=str(stats["queued"]))
+        embed.add_field(name="Written", value=str(stats["written"]))
+        embed.add_field(name="Batches", value=str(stats["batches"]))
+        embed.add_field(name="Failed Batches", value=str(stats["failed_batches"]))
+        embed.add_field(name="Avg. Write Time", value=f"{write_ms:.1f} ms")
+        embed.add_field(name="Blocked Puts", value=str(stats["blocked"]))
+        embed.add_field(name="Time Blocked", value=f"{stats['blocked_ms']} ms")
+
+        archiver, stats = self.attachments, self.attachments.stats
+        used = f"{archiver.used / 2 ** 20:.1f}/{archiver.quota / 2 ** 20:.0f} MiB"
+        embed.add_field(name="Attachment Queue", value=str(archiver.queue.qsize()))
+        embed.add_field(name="Attachment Storage", value=used)
+        embed.add_field(name="Attachments Stored", value=str(stats["stored"]))
+        embed.add_field(name="Deduplicated", value=str(stats["deduplicated"]))
+        embed.add_field(name="Evicted", value=str(stats["evicted"]))
+        embed.add_field(name="Dropped / Failed", value=f"{stats['dropped']} / {stats['failed']}")
+        await ctx.send(embed=embed)
+
+    @logs.command()
+    @commands.has_permissions(administrator=True)
+    async def train(self, ctx, samples: int = 20000):
+        """Trains a new compression dictionary from a sample of recent messages.
+
+        You must have the Administrator permission to use this.
+        """
+
+        if not self.compressed:
+            return await ctx.send("The message archive is not compressed.")
+
+        collection = self.message_collection(ctx.message.id)
+        docs = await collection.aggregate([{"$sample": {"size": samples}}]).to_list(None)
+        texts = [x for doc in await self.decode_messages(docs) for x in doc["history"].values()]
+        if len(texts) == 0:
+            return await ctx.send("There are no messages to train on yet.")
+
+        # Versions are claimed by inserting them, so two processes can't both take one
+        data = train_dictionary(texts)
+        while True:
+            latest = await self.bot.mongo.db.archive_dictionary.find_one(sort=[("_id", -1)])
+            version = 1 if latest is None else latest["_id"] + 1
+            if version > 255:
+                return await ctx.send("All 255 dictionary versions are in use.")
+            try:
+                await self.bot.mongo.db.archive_dictionary.insert_one(
+                    {"_id": version, "data": data, "created_at": datetime.utcnow()}
+                )
+                break
+            except DuplicateKeyError:
+                continue
+        self.codec.add_dictionary(version, data)
+        self.codec.use_dictionary(version)
+        await ctx.send(f"Trained dictionary **{version}** on {len(texts)} messages.")
+
+    @logs.command()
+    @commands.has_permissions(administrator=True)
+    async def sync(self, ctx):
+        """Writes any guild, channel and member changes the database is missing.
+
+        You must have the Administrator permission to use this.
+        """
+
+        message = await ctx.send("Syncing...")
+
+        async def progress(done, total):
+            if done % 5000 == 0:
+                await message.edit(content=f"Syncing... {done}/{total} checked")
+
+        start = time.perf_counter()
+        written, total = await self.reconcile_guild(ctx.guild, progress=progress)
+        duration = time.perf_counter() - start
+        await message.edit(content=f"Wrote {written} of {total} documents in {duration:.2f}s.")
+
+    @logs.command()
+    @commands.has_permissions(administrator=True)
+    async def migrate(self, ctx, batch_size: int = 1000):
+        """Moves messages into the compressed monthly archive.
+
+        You must have the Administrator permission to use this.
+        """
+
+        if not self.compressed:
+            return await ctx.send("The message archive is not compressed.")
+
+        async def migrate_batch(batch):
+            await self.insert_messages(batch)
+            ids = [x["_id"] for x in batch]
+            await self.bot.mongo.db.message.delete_many({"_id": {"$in": ids}})
+
+        message = await ctx.send("Migrating messages...")
+        count, batch = 0, []
+        async for doc in self.bot.mongo.db.message.find(batch_size=batch_size).sort("_id", 1):
+            doc["history"] = {
+                k: self.encode_content(v) if isinstance(v, str) else v
+                for k, v in doc["history"].items()
+            }
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                await migrate_batch(batch)
+                count, batch = count + len(batch), []
+                if count % (10 * batch_size) == 0:
+                    await message.edit(content=f"Migrating messages... {count} done")
+
+        if len(batch) > 0:
+            await migrate_batch(batch)
+            count += len(batch)
+
+        await message.edit(content=f"Migrated {count} messages.")
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def search(self, ctx, *, query):
+        """Searches archived messages for words.
+
+        Narrow down results with in:#channel, from:@user, after:date and before:date, or
+        include deleted messages with deleted:yes.
+
+        You must have the Manage Messages permission to use this.
+        """
+
+        if not self.search_ready:
+            return await ctx.send("The search index is still loading, please try again later.")
+
+        words, filters = [], {}
+        for word in query.split():
+            key, _, value = word.partition(":")
+            if key in ("in", "from", "after", "before", "deleted") and value != "":
+                filters[key] = value
+            else:
+                words.append(word)
+
+        kwargs = {}
+        try:
+            if "in" in filters:
+                channel = await commands.TextChannelConverter().convert(ctx, filters["in"])
+                kwargs["channel_id"] = channel.id
+            if "from" in filters:
+                user = await FetchUserConverter().convert(ctx, filters["from"])
+                kwargs["user_id"] = user.id
+            if "after" in filters:
+                kwargs["after"], _ = snowflake_range(start=parse(filters["after"]))
+            if "before" in filters:
+                _, kwargs["before"] = snowflake_range(end=parse(filters["before"]))
+        except (ValueError, OverflowError):
+            return await ctx.send("Invalid date.")
+        kwargs["include_deleted"] = filters.get("deleted") in ("yes", "true")
+
+        text = " ".join(words)
+        ids = self.search_index.search(text, **kwargs)
+        restricted = self.bot.mongo.db.channel.find({"restricted": True}, {"_id": 1})
+        restricted = {x["_id"] async for x in restricted}
+        admin = ctx.author.guild_permissions.administrator
+
+        async def get_messages():
+            for message_id in ids:
+                doc = await self.fetch_message(message_id)
+                if doc is None:
+                    continue
+                channel = ctx.guild.get_channel(doc["channel_id"])
+                if channel is None or not channel.permissions_for(ctx.author).read_messages:
+                    continue
+                if doc["channel_id"] in restricted and not admin:
+                    continue
+                yield doc
+
+        def format_item(i, x):
+            author = ctx.guild.get_member(x["user_id"]) or x["user_id"]
+            created_at = discord.utils.snowflake_time(x["_id"])
+            deleted = " (deleted)" if x["deleted_at"] is not None else ""
+            content = x["versions"][-1][1] or "*No content*"
+            url = f"https://discord.com/channels/{ctx.guild.id}/{x['channel_id']}/{x['_id']}"
+            return {
+                "name": f"{author} in #{ctx.guild.get_channel(x['channel_id'])}{deleted}",
+                "value": f"{content[:900]}\n[{created_at:%m-%d-%y %I:%M %p}]({url})",
+                "inline": False,
+            }
+
+        pages = menus.MenuPages(
+            source=AsyncFieldsPageSource(
+                get_messages(),
+                title=f"Search Results • {text}",
+                format_item=format_item,
+            )
+        )
+
+        try:
+            await pages.start(ctx)
+        except IndexError:
+            await ctx.send("No messages found.")
+
+    def cog_unload(self):
+        self._load_task.cancel()
+        self._reconcile_task.cancel()
+        self._search_task.cancel()
+        self.save_search_index.cancel()
+        self.retention_task.cancel()
+        self.bot.loop.create_task(self.writer.close())
+        self.bot.loop.create_task(self.attachments.close())
+        self.compactor.shutdown(wait=False)
+        self.log_files.stop()
+
 
 def setup(bot):
     bot.add_cog(Logging(bot))
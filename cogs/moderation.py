@@ -5,18 +5,25 @@
 # Copyright (c) 2021 Oliver Ni
 
 import abc
+import asyncio
+import re
+import sys
+import traceback
 from collections import Counter
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional, Union
 
 import discord
-from discord import CategoryChannel
 from discord.ext import commands, menus, tasks
 from discord.ext.events.utils import fetch_recent_audit_log_entry
 from helpers import time
+from helpers.bulk import run_bulk
+from helpers.archive import snowflake_range
 from helpers.pagination import AsyncFieldsPageSource
+from helpers.scheduler import TimerHeap
 from helpers.utils import FakeUser, FetchUserConverter
+from pymongo import InsertOne, UpdateMany, UpdateOne
 
 TimeDelta = Optional[time.TimeDelta]
 
@@ -31,6 +38,9 @@ class Action(abc.ABC):
     resolved: bool = None
     _id: int = None
 
+    # Fields set on the target's member document when the action is saved
+    member_update = None
+
     def __post_init__(self):
         if self.created_at is None:
             self.created_at = datetime.utcnow()
@@ -109,7 +119,12 @@ class Action(abc.ABC):
             pass
 
     @abc.abstractmethod
+    async def apply(self, ctx):
+        """Carries out the action on Discord."""
+
     async def execute(self, ctx):
+        await self.apply(ctx)
+        await ctx.bot.get_cog("Moderation").save_actions([self])
         ctx.bot.dispatch("action_perform", self)
 
 
@@ -119,10 +134,9 @@ class Kick(Action):
     emoji = "\N{WOMANS BOOTS}"
     color = discord.Color.orange()
 
-    async def execute(self, ctx):
+    async def apply(self, ctx):
         reason = self.reason or f"Action done by {self.user} (ID: {self.user.id})"
         await ctx.guild.kick(self.target, reason=reason)
-        await super().execute(ctx)
 
 
 class Ban(Action):
@@ -131,10 +145,9 @@ class Ban(Action):
     emoji = "\N{HAMMER}"
     color = discord.Color.red()
 
-    async def execute(self, ctx):
+    async def apply(self, ctx):
         reason = self.reason or f"Action done by {self.user} (ID: {self.user.id})"
         await ctx.guild.ban(self.target, reason=reason)
-        await super().execute(ctx)
 
 
 class Unban(Action):
@@ -143,10 +156,9 @@ class Unban(Action):
     emoji = "\N{OPEN LOCK}"
     color = discord.Color.green()
 
-    async def execute(self, ctx):
+    async def apply(self, ctx):
         reason = self.reason or f"Action done by {self.user} (ID: {self.user.id})"
         await ctx.guild.unban(self.target, reason=reason)
-        await super().execute(ctx)
 
 
 class Warn(Action):
@@ -155,8 +167,8 @@ class Warn(Action):
     emoji = "\N{WARNING SIGN}"
     color = discord.Color.orange()
 
-    async def execute(self, ctx):
-        await super().execute(ctx)
+    async def apply(self, ctx):
+        pass
 
 
 class Mute(Action):
@@ -164,15 +176,12 @@ class Mute(Action):
     past_tense = "muted"
     emoji = "\N{SPEAKER WITH CANCELLATION STROKE}"
     color = discord.Color.blue()
+    member_update = {"muted": True}
 
-    async def execute(self, ctx):
+    async def apply(self, ctx):
         reason = self.reason or f"Action done by {self.user} (ID: {self.user.id})"
         role = discord.utils.get(ctx.guild.roles, name="Muted")
         await self.target.add_roles(role, reason=reason)
-        await ctx.bot.mongo.db.member.update_one(
-            {"_id": self.target.id}, {"$set": {"muted": True}}, upsert=True
-        )
-        await super().execute(ctx)
 
 
 class Unmute(Action):
@@ -180,15 +189,12 @@ class Unmute(Action):
     past_tense = "unmuted"
     emoji = "\N{SPEAKER}"
     color = discord.Color.green()
+    member_update = {"muted": False}
 
-    async def execute(self, ctx):
+    async def apply(self, ctx):
         reason = self.reason or f"Action done by {self.user} (ID: {self.user.id})"
         role = discord.utils.get(ctx.guild.roles, name="Muted")
         await self.target.remove_roles(role, reason=reason)
-        await ctx.bot.mongo.db.member.update_one(
-            {"_id": self.target.id}, {"$set": {"muted": False}}, upsert=True
-        )
-        await super().execute(ctx)
 
 
 cls_dict = {x.type: x for x in (Kick, Ban, Unban, Warn, Mute, Unmute)}
@@ -235,12 +241,71 @@ class Moderation(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.cls_dict = cls_dict
-        self.check_actions.start()
+        self.expiries = TimerHeap(self.reverse_action)
+        self.expiries.start(bot.loop)
+        self.reconcile_expiries.start()
+        self.log_queue = asyncio.Queue()
+        self._log_task = bot.loop.create_task(self.post_log_messages())
 
     async def send_log_message(self, *args, **kwargs):
         channel = self.bot.get_channel(self.bot.config.LOGS_CHANNEL_ID)
         await channel.send(*args, **kwargs)
 
+    async def post_log_messages(self):
+        await self.bot.wait_until_ready()
+        while True:
+            embed = await self.log_queue.get()
+            try:
+                await self.send_log_message(embed=embed)
+            except Exception as error:
+                print("Ignoring exception posting action log:", file=sys.stderr)
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+            finally:
+                self.log_queue.task_done()
+
+    async def save_actions(self, actions, log=True):
+        """Stores actions, then queues their log messages.
+
+        Member document changes, such as the muted flag, are written first in one bulk
+        write. The actions follow in a second, ordered bulk write, where each insert is
+        preceded by an update resolving earlier unresolved actions of the same type against
+        the same target. The member changes reflect what was already done on Discord, so
+        they are kept even if storing the actions fails.
+        """
+
+        member_ops = [
+            UpdateOne({"_id": x.target.id}, {"$set": x.member_update}, upsert=True)
+            for x in actions
+            if x.member_update is not None
+        ]
+        if len(member_ops) > 0:
+            await self.bot.mongo.db.member.bulk_write(member_ops, ordered=True)
+
+        ops = []
+        for action in actions:
+            action._id = await self.bot.mongo.next_id("action")
+            ops.append(
+                UpdateMany(
+                    {"target_id": action.target.id, "type": action.type, "resolved": False},
+                    {"$set": {"resolved": True}},
+                )
+            )
+            ops.append(InsertOne({"_id": action._id, **action.to_dict()}))
+        await self.bot.mongo.db.action.bulk_write(ops, ordered=True)
+
+        for action in actions:
+            if action.expires_at is not None:
+                self.expiries.schedule(action._id, action.expires_at)
+            if log:
+                self.log_queue.put_nowait(action.to_log_embed())
+
+    async def flush(self, timeout=10):
+        # The worker may never have started, or the log channel may be rate limited
+        try:
+            await asyncio.wait_for(self.log_queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Dropping {self.log_queue.qsize()} unposted action logs", file=sys.stderr)
+
     @commands.Cog.listener()
     async def on_member_join(self, member):
         data = await self.bot.mongo.db.member.find_one({"_id": member.id})
@@ -253,13 +318,9 @@ class Moderation(commands.Cog):
 
     @commands.Cog.listener()
     async def on_action_perform(self, action):
-        await self.bot.mongo.db.action.update_many(
-            {"target_id": action.target.id, "type": action.type, "resolved": False},
-            {"$set": {"resolved": True}},
-        )
-        id = await self.bot.mongo.reserve_id("action")
-        await self.bot.mongo.db.action.insert_one({"_id": id, **action.to_dict()})
-        await self.send_log_message(embed=action.to_log_embed())
+        # Actions made outside the bot, e.g. from the audit log, aren't saved yet
+        if action._id is None:
+            await self.save_actions([action])
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild, target):
@@ -331,6 +392,56 @@ class Moderation(commands.Cog):
 
         await ctx.send("\n".join(messages), delete_after=5)
 
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    async def deleted(
+        self, ctx, channel: Optional[discord.TextChannel] = None, *, window: TimeDelta = None
+    ):
+        """Views messages deleted from a channel within a time window (default 1 hour).
+
+        You must have the Manage Messages permission to use this.
+        """
+
+        channel = channel or ctx.channel
+        window = window or timedelta(hours=1)
+
+        if channel.guild != ctx.guild or not channel.permissions_for(ctx.author).read_messages:
+            return await ctx.send("You can't view that channel.")
+
+        doc = await self.bot.mongo.db.channel.find_one({"_id": channel.id})
+        restricted = doc is not None and doc.get("restricted", False)
+        if restricted and not ctx.author.guild_permissions.administrator:
+            return await ctx.send("The logs for that channel are restricted to Admins.")
+
+        after, _ = snowflake_range(datetime.utcnow() - window)
+        messages = self.bot.get_cog("Logging").iter_messages(
+            channel.id, after=after, deleted_at={"$ne": None}
+        )
+
+        def format_item(i, x):
+            author = channel.guild.get_member(x["user_id"]) or x["user_id"]
+            created_at = discord.utils.snowflake_time(x["_id"])
+            content = x["versions"][-1][1] or "*No content*"
+            return {
+                "name": f"{author} at {created_at:%m-%d-%y %I:%M %p}",
+                "value": content[:1024],
+                "inline": False,
+            }
+
+        pages = menus.MenuPages(
+            source=AsyncFieldsPageSource(
+                messages,
+                title=f"Deleted Messages • #{channel}",
+                format_item=format_item,
+            )
+        )
+
+        try:
+            await pages.start(ctx)
+        except IndexError:
+            await ctx.send("No deleted messages found.")
+
     @commands.command()
     @commands.guild_only()
     @commands.has_permissions(kick_members=True)
@@ -462,11 +573,26 @@ class Moderation(commands.Cog):
         if role is None:
             return await ctx.send("Please create a role named Muted first.")
 
-        for channel in ctx.guild.channels:
-            if isinstance(channel, CategoryChannel) or not channel.permissions_synced:
-                await channel.set_permissions(role, send_messages=False, speak=False, stream=False)
+        # Editing every channel that differs keeps synced channels in sync with their category
+        overwrite = discord.PermissionOverwrite(send_messages=False, speak=False, stream=False)
+        channels = [x for x in ctx.guild.channels if x.overwrites_for(role) != overwrite]
+        if len(channels) == 0:
+            return await ctx.send("The Muted role's permissions are already set up.")
 
-        await ctx.send("Set up permissions for the Muted role.")
+        message = await ctx.send(f"Setting up permissions in {len(channels)} channels...")
+
+        async def progress(done, total):
+            await message.edit(content=f"Setting up permissions... {done}/{total} channels done")
+
+        failures = await run_bulk(
+            lambda x: x.set_permissions(role, overwrite=overwrite), channels, progress=progress
+        )
+
+        if len(failures) > 0:
+            failed = ", ".join(f"**#{x}**" for x, _ in failures)
+            await ctx.send(f"Couldn't set up permissions in {failed}.")
+        else:
+            await ctx.send("Set up permissions for the Muted role.")
 
     @commands.command()
     @commands.guild_only()
@@ -482,6 +608,199 @@ class Moderation(commands.Cog):
         await action.notify()
         await ctx.send(f"Unmuted **{target}**.")
 
+    def can_punish(self, ctx, target):
+        if not isinstance(target, discord.Member):
+            return True
+        if target in (ctx.author, ctx.guild.me, ctx.guild.owner):
+            return False
+        if target.top_role >= ctx.guild.me.top_role:
+            return False
+        return ctx.author == ctx.guild.owner or target.top_role < ctx.author.top_role
+
+    def mass_log_embed(self, ctx, cls, actions, reason):
+        embed = discord.Embed(color=cls.color)
+        embed.set_author(name=f"{ctx.author} (ID: {ctx.author.id})", icon_url=ctx.author.avatar_url)
+        embed.add_field(
+            name=f"{cls.emoji} {cls.past_tense.title()} {len(actions)} members",
+            value=reason or "No reason provided",
+            inline=False,
+        )
+
+        lines, length = [], 0
+        for i, action in enumerate(actions):
+            line = f"{action.target} (ID: {action.target.id})"
+            if length + len(line) > 950:
+                lines.append(f"…and {len(actions) - i} more")
+                break
+            lines.append(line)
+            length += len(line) + 1
+        embed.add_field(name="Members", value="\n".join(lines), inline=False)
+        return embed
+
+    async def run_mass_action(self, ctx, cls, targets, reason):
+        """Applies an action to many targets at once, then saves them together.
+
+        Actions are applied through run_bulk, then stored with one bulk write and
+        summarized in a single log message. Targets aren't sent DMs.
+        """
+
+        targets = [x for x in targets if self.can_punish(ctx, x)]
+        if len(targets) == 0:
+            return await ctx.send("No members matched.")
+
+        preview = ", ".join(f"**{x}**" for x in targets[:10])
+        if len(targets) > 10:
+            preview += f" and {len(targets) - 10} more"
+        await ctx.send(
+            f"This will {cls.type} **{len(targets)}** members: {preview}.\n"
+            f"Type `confirm` within 30 seconds to continue."
+        )
+        try:
+            await self.bot.wait_for(
+                "message",
+                check=lambda m: m.author == ctx.author
+                and m.channel == ctx.channel
+                and m.content.lower() == "confirm",
+                timeout=30,
+            )
+        except asyncio.TimeoutError:
+            return await ctx.send("Cancelled.")
+
+        message = await ctx.send(f"{cls.past_tense.title()} 0/{len(targets)} members...")
+
+        async def progress(done, total):
+            await message.edit(content=f"{cls.past_tense.title()} {done}/{total} members...")
+
+        created_at = datetime.utcnow()
+        actions = [
+            cls(target=x, user=ctx.author, reason=reason, created_at=created_at) for x in targets
+        ]
+        applied = []
+
+        async def apply(action):
+            await action.apply(ctx)
+            applied.append(action)
+
+        start = self.bot.loop.time()
+        failures = await run_bulk(apply, actions, concurrency=10, per_second=20, progress=progress)
+        if len(applied) > 0:
+            await self.save_actions(applied, log=False)
+            self.log_queue.put_nowait(self.mass_log_embed(ctx, cls, applied, reason))
+            for action in applied:
+                self.bot.dispatch("action_perform", action)
+        duration = self.bot.loop.time() - start
+
+        result = f"{cls.past_tense.title()} **{len(applied)}** members in {duration:.1f}s."
+        if len(failures) > 0:
+            result += f" Failed for {len(failures)}: "
+            result += ", ".join(f"**{x.target}**" for x, _ in failures[:10])
+        await ctx.send(result)
+
+    def members_joined_within(self, guild, window):
+        since = datetime.utcnow() - window
+        return [x for x in guild.members if x.joined_at is not None and x.joined_at > since]
+
+    def members_matching(self, guild, pattern):
+        try:
+            regex = re.compile(pattern)
+        except re.error:
+            raise commands.BadArgument("Invalid regular expression.")
+        return [x for x in guild.members if regex.search(x.name)]
+
+    @commands.group(invoke_without_command=True)
+    @commands.guild_only()
+    @commands.has_permissions(ban_members=True)
+    async def massban(self, ctx):
+        """Bans many members at once, chosen by one of the subcommands.
+
+        You must have the Ban Members permission to use this.
+        """
+
+        await ctx.send_help(ctx.command)
+
+    @massban.command(name="ids")
+    @commands.guild_only()
+    @commands.has_permissions(ban_members=True)
+    async def massban_ids(self, ctx, ids: commands.Greedy[int], *, reason=None):
+        """Bans users by ID, whether or not they're in the server.
+
+        You must have the Ban Members permission to use this.
+        """
+
+        targets = [ctx.guild.get_member(x) or FakeUser(x) for x in dict.fromkeys(ids)]
+        await self.run_mass_action(ctx, Ban, targets, reason)
+
+    @massban.command(name="joined")
+    @commands.guild_only()
+    @commands.has_permissions(ban_members=True)
+    async def massban_joined(self, ctx, window: time.TimeDelta, *, reason=None):
+        """Bans members who joined within a time window, e.g. 10m.
+
+        You must have the Ban Members permission to use this.
+        """
+
+        targets = self.members_joined_within(ctx.guild, window)
+        await self.run_mass_action(ctx, Ban, targets, reason)
+
+    @massban.command(name="regex")
+    @commands.guild_only()
+    @commands.has_permissions(ban_members=True)
+    async def massban_regex(self, ctx, pattern, *, reason=None):
+        """Bans members whose username matches a regular expression.
+
+        You must have the Ban Members permission to use this.
+        """
+
+        targets = self.members_matching(ctx.guild, pattern)
+        await self.run_mass_action(ctx, Ban, targets, reason)
+
+    @commands.group(invoke_without_command=True)
+    @commands.guild_only()
+    @commands.has_permissions(kick_members=True)
+    async def massmute(self, ctx):
+        """Mutes many members at once, chosen by one of the subcommands.
+
+        You must have the Kick Members permission to use this.
+        """
+
+        await ctx.send_help(ctx.command)
+
+    @massmute.command(name="ids")
+    @commands.guild_only()
+    @commands.has_permissions(kick_members=True)
+    async def massmute_ids(self, ctx, ids: commands.Greedy[int], *, reason=None):
+        """Mutes members by ID.
+
+        You must have the Kick Members permission to use this.
+        """
+
+        targets = [ctx.guild.get_member(x) for x in dict.fromkeys(ids)]
+        await self.run_mass_action(ctx, Mute, [x for x in targets if x is not None], reason)
+
+    @massmute.command(name="joined")
+    @commands.guild_only()
+    @commands.has_permissions(kick_members=True)
+    async def massmute_joined(self, ctx, window: time.TimeDelta, *, reason=None):
+        """Mutes members who joined within a time window, e.g. 10m.
+
+        You must have the Kick Members permission to use this.
+        """
+
+        targets = self.members_joined_within(ctx.guild, window)
+        await self.run_mass_action(ctx, Mute, targets, reason)
+
+    @massmute.command(name="regex")
+    @commands.guild_only()
+    @commands.has_permissions(kick_members=True)
+    async def massmute_regex(self, ctx, pattern, *, reason=None):
+        """Mutes members whose username matches a regular expression.
+
+        You must have the Kick Members permission to use this.
+        """
+
+        targets = self.members_matching(ctx.guild, pattern)
+        await self.run_mass_action(ctx, Mute, targets, reason)
+
     async def reverse_raw_action(self, raw_action):
         action = Action.build_from_mongo(self.bot, raw_action)
 
@@ -493,6 +812,9 @@ class Moderation(commands.Cog):
             try:
                 ban = await guild.fetch_ban(discord.Object(id=raw_action["target_id"]))
             except (ValueError, discord.NotFound):
+                await self.bot.mongo.db.action.update_one(
+                    {"_id": raw_action["_id"]}, {"$set": {"resolved": True}}
+                )
                 return
             target = ban.user
         elif action.type == "mute":
@@ -512,14 +834,21 @@ class Moderation(commands.Cog):
 
         await self.bot.mongo.db.action.update_one({"_id": raw_action["_id"]}, {"$set": {"resolved": True}})
 
-    @tasks.loop(seconds=15)
-    async def check_actions(self):
-        query = {"resolved": False, "expires_at": {"$lt": datetime.utcnow()}}
-        async for action in self.bot.mongo.db.action.find(query):
-            self.bot.loop.create_task(self.reverse_raw_action(action))
-
-    @check_actions.before_loop
-    async def before_check_actions(self):
+    async def reverse_action(self, id):
+        # The action may have been resolved or deleted since it was scheduled
+        raw_action = await self.bot.mongo.db.action.find_one({"_id": id, "resolved": False})
+        if raw_action is not None:
+            await self.reverse_raw_action(raw_action)
+
+    @tasks.loop(minutes=10)
+    async def reconcile_expiries(self):
+        query = {"resolved": False, "expires_at": {"$ne": None}}
+        async for action in self.bot.mongo.db.action.find(query, {"expires_at": 1}):
+            if action["_id"] not in self.expiries.inflight:
+                self.expiries.schedule(action["_id"], action["expires_at"])
+
+    @reconcile_expiries.before_loop
+    async def before_reconcile_expiries(self):
         await self.bot.wait_until_ready()
 
     @commands.group(invoke_without_command=True)
@@ -573,11 +902,15 @@ class Moderation(commands.Cog):
         """
 
         result = await self.bot.mongo.db.action.delete_many({"_id": {"$in": ids}})
+        for id in ids:
+            self.expiries.cancel(id)
         word = "entry" if result.deleted_count == 1 else "entries"
         await ctx.send(f"Successfully deleted {result.deleted_count} {word}.")
 
     def cog_unload(self):
-        self.check_actions.cancel()
+        self._log_task.cancel()
+        self.reconcile_expiries.cancel()
+        self.expiries.close()
 
 
 def setup(bot):
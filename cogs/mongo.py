@@ -4,10 +4,38 @@
 
 # Copyright (c) 2021 Oliver Ni
 
+import asyncio
+
 from discord.ext import commands
 from motor.motor_asyncio import AsyncIOMotorClient
 
 
+class IdAllocator:
+    """Hands out IDs for a counter from blocks reserved with a single atomic $inc.
+
+    Every process reserves its own blocks, so IDs are never handed out twice. IDs left
+    in a block when the process stops are skipped, so there may be gaps, and IDs from
+    different processes aren't in creation order.
+    """
+
+    def __init__(self, mongo, name, block_size=50):
+        self.mongo = mongo
+        self.name = name
+        self.block_size = block_size
+        self.next = 0
+        self.end = 0
+        self._lock = asyncio.Lock()
+
+    async def next_id(self):
+        async with self._lock:
+            if self.next >= self.end:
+                self.next = await self.mongo.reserve_id(self.name, self.block_size)
+                self.end = self.next + self.block_size
+            id = self.next
+            self.next += 1
+            return id
+
+
 class Mongo(commands.Cog):
     """For database operations."""
 
@@ -15,6 +43,7 @@ class Mongo(commands.Cog):
         self.bot = bot
         self.client = AsyncIOMotorClient(bot.config.DATABASE_URI, io_loop=bot.loop)
         self.db = self.client[bot.config.DATABASE_NAME]
+        self.allocators = {}
 
     async def reserve_id(self, name, reserve=1):
         result = await self.db.counter.find_one_and_update(
@@ -24,6 +53,11 @@ class Mongo(commands.Cog):
             return 0
         return result["next"]
 
+    async def next_id(self, name, block_size=50):
+        if name not in self.allocators:
+            self.allocators[name] = IdAllocator(self, name, block_size)
+        return await self.allocators[name].next_id()
+
 
 def setup(bot):
     bot.add_cog(Mongo(bot))
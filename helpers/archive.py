@@ -0,0 +1,179 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import difflib
+import gzip
+import json
+import os
+import zlib
+from collections import Counter, defaultdict
+from datetime import timezone
+
+import discord
+
+
+def archive_collection_name(message_id):
+    """Returns the name of the monthly collection a message is archived in."""
+
+    return f"message_{discord.utils.snowflake_time(message_id):%Y_%m}"
+
+
+def snowflake_range(start=None, end=None):
+    """Returns exclusive (after, before) ID bounds for snowflakes created in [start, end).
+
+    Either bound may be None to leave that side open.
+    """
+
+    def naive(dt):
+        return dt if dt.tzinfo is None else dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+    after = None if start is None else discord.utils.time_snowflake(naive(start)) - 1
+    before = None if end is None else discord.utils.time_snowflake(naive(end))
+    return after, before
+
+
+def append_ndjson(path, docs):
+    """Appends documents to a gzipped newline-delimited JSON file and syncs it to disk.
+
+    Each call adds a new gzip member, which readers decompress as one stream.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab") as f:
+            for doc in docs:
+                f.write(json.dumps(doc, default=str).encode("utf-8") + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def diff_content(old, new):
+    """Returns the edits that turn old into new, as [start, end, replacement] lists."""
+
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    return [[i1, i2, new[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def patch_content(old, delta):
+    parts, pos = [], 0
+    for start, end, replacement in delta:
+        parts.append(old[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(old[pos:])
+    return "".join(parts)
+
+
+def content_key(content):
+    """Identifies a version by its length and CRC-32, so deltas can name their base."""
+
+    return len(content), zlib.crc32(content.encode("utf-8"))
+
+
+def message_versions(doc):
+    """Yields (timestamp, content) for every version of an archived message.
+
+    Versions come from the history dict followed by the edits list, where each edit is
+    either a full keyframe under "c" or a delta under "d" against the version keyed by "b".
+    Edits may have been stored out of order, so deltas wait for their base to appear, and
+    deltas whose base never does are skipped rather than applied to the wrong version.
+    Deltas without a base key are applied to the previous version.
+    """
+
+    content = None
+    known = {}
+    for time, content in sorted(doc["history"].items(), key=lambda x: int(x[0])):
+        known[content_key(content)] = content
+        yield int(time), content
+
+    versions, waiting = [], defaultdict(list)
+    for edit in doc.get("edits", []):
+        if "c" in edit:
+            resolved = [(edit, edit["c"])]
+        elif "b" not in edit:
+            if content is None:
+                continue
+            resolved = [(edit, patch_content(content, edit["d"]))]
+        elif tuple(edit["b"]) in known:
+            resolved = [(edit, patch_content(known[tuple(edit["b"])], edit["d"]))]
+        else:
+            waiting[tuple(edit["b"])].append(edit)
+            continue
+
+        while len(resolved) > 0:
+            edit, content = resolved.pop()
+            versions.append((edit["t"], content))
+            key = content_key(content)
+            known[key] = content
+            resolved.extend((x, patch_content(content, x["d"])) for x in waiting.pop(key, []))
+
+    versions.sort(key=lambda x: x[0])
+    yield from versions
+
+
+def train_dictionary(samples, size=16384):
+    """Builds a preset deflate dictionary from the most common words and word pairs.
+
+    zlib can reach further back into the dictionary cheaply, so the most valuable
+    strings are placed at the end.
+    """
+
+    counts = Counter()
+    for text in samples:
+        words = text.split()
+        counts.update(f"{x} " for x in words)
+        counts.update(f"{x} {y} " for x, y in zip(words, words[1:]))
+
+    scored = sorted(((count * len(x), x) for x, count in counts.items() if count > 1), reverse=True)
+    chosen, total = [], 0
+    for _, string in scored:
+        data = string.encode("utf-8")
+        if total + len(data) > size:
+            continue
+        chosen.append(data)
+        total += len(data)
+    return b"".join(reversed(chosen))
+
+
+class MessageCodec:
+    """Compresses message content with raw deflate and a versioned preset dictionary.
+
+    The first byte of the compressed data is the dictionary version, so content
+    compressed with older dictionaries stays readable after retraining. Version 0 means
+    no dictionary. Plain strings are passed through decompress unchanged.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.compressors = {}
+        self.decompressors = {}
+        self.add_dictionary(0, b"")
+
+    def add_dictionary(self, version, data):
+        if not 0 <= version < 256:
+            raise ValueError("Dictionary version must fit in one byte.")
+        kwargs = {"zdict": data} if len(data) > 0 else {}
+        self.compressors[version] = zlib.compressobj(6, zlib.DEFLATED, -15, **kwargs)
+        self.decompressors[version] = zlib.decompressobj(-15, **kwargs)
+
+    def use_dictionary(self, version):
+        self.version = version
+
+    def missing_versions(self, values):
+        """Returns the dictionary versions needed to decompress values that aren't loaded."""
+
+        return {x[0] for x in values if isinstance(x, bytes) and x[0] not in self.decompressors}
+
+    def compress(self, text):
+        compressor = self.compressors[self.version].copy()
+        data = compressor.compress(text.encode("utf-8")) + compressor.flush()
+        return bytes((self.version,)) + data
+
+    def decompress(self, data):
+        if isinstance(data, str):
+            return data
+        decompressor = self.decompressors[data[0]].copy()
+        return (decompressor.decompress(data[1:]) + decompressor.flush()).decode("utf-8")
@@ -0,0 +1,240 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import asyncio
+import functools
+import hashlib
+import os
+import sys
+import traceback
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+import aiohttp
+from pymongo import ASCENDING
+
+
+class AttachmentArchiver:
+    """Mirrors message attachments to disk, stored by the SHA-256 of their content.
+
+    Downloads go through a fixed number of workers and are streamed to disk in chunks.
+    The attachment collection maps attachment IDs to blobs, and the attachment_blob
+    collection tracks each blob's size and last use. Once the store exceeds its quota,
+    the least recently used blobs are evicted, starting with those not referenced by a
+    deleted message.
+    """
+
+    def __init__(
+        self,
+        bot,
+        root="attachments",
+        workers=4,
+        max_queue=1000,
+        quota=10 * 2 ** 30,
+        timeout=aiohttp.ClientTimeout(total=300, sock_connect=10, sock_read=30),
+    ):
+        self.bot = bot
+        self.root = Path(root)
+        self.quota = quota
+        self.used = 0
+        self.stats = Counter()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.timeout = timeout
+        self.session = None
+        self.active = 0
+        self.queued = Counter()
+        self.deleted = set()
+        self._setup_task = bot.loop.create_task(self.setup_with_retry())
+        self._workers = [bot.loop.create_task(self.worker()) for _ in range(workers)]
+
+    @property
+    def db(self):
+        return self.bot.mongo.db
+
+    async def setup(self):
+        (self.root / "tmp").mkdir(parents=True, exist_ok=True)
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+        await self.db.attachment.create_index([("message_id", ASCENDING)])
+        await self.db.attachment_blob.create_index(
+            [("pinned", ASCENDING), ("last_used", ASCENDING)]
+        )
+        pipeline = [{"$group": {"_id": None, "size": {"$sum": "$size"}}}]
+        async for x in self.db.attachment_blob.aggregate(pipeline):
+            self.used = x["size"]
+
+    async def setup_with_retry(self, max_delay=300):
+        delay = 1
+        while True:
+            try:
+                await self.setup()
+                return
+            except Exception as error:
+                print(f"Attachment archive setup failed, retrying in {delay}s:", file=sys.stderr)
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    def blob_path(self, digest):
+        return self.root / digest[:2] / digest
+
+    @staticmethod
+    def store_blob(tmp, path):
+        if path.exists():
+            tmp.unlink()
+        else:
+            path.parent.mkdir(exist_ok=True)
+            os.replace(tmp, path)
+
+    async def run_in_executor(self, func, *args):
+        return await self.bot.loop.run_in_executor(None, func, *args)
+
+    def enqueue(self, message):
+        for attachment in message.attachments:
+            try:
+                self.queue.put_nowait((message.id, attachment))
+                self.queued[message.id] += 1
+            except asyncio.QueueFull:
+                self.stats["dropped"] += 1
+
+    def done(self, message_id):
+        self.queued[message_id] -= 1
+        if self.queued[message_id] <= 0:
+            del self.queued[message_id]
+            self.deleted.discard(message_id)
+
+    async def worker(self):
+        await self._setup_task
+        while True:
+            message_id, attachment = await self.queue.get()
+            self.active += 1
+            try:
+                await self.archive(message_id, attachment)
+            except Exception as error:
+                self.stats["failed"] += 1
+                print(f"Ignoring exception archiving attachment {attachment.id}:", file=sys.stderr)
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+            finally:
+                self.active -= 1
+                self.done(message_id)
+                self.queue.task_done()
+
+    async def download(self, attachment):
+        tmp = self.root / "tmp" / uuid.uuid4().hex
+        digest, size = hashlib.sha256(), 0
+        f = None
+        try:
+            async with self.session.get(attachment.proxy_url) as resp:
+                resp.raise_for_status()
+                f = await self.run_in_executor(tmp.open, "wb")
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    digest.update(chunk)
+                    await self.run_in_executor(f.write, chunk)
+                    size += len(chunk)
+        except BaseException:
+            if f is not None:
+                f.close()
+            await self.run_in_executor(functools.partial(tmp.unlink, missing_ok=True))
+            raise
+        await self.run_in_executor(f.close)
+        return tmp, digest.hexdigest(), size
+
+    async def archive(self, message_id, attachment):
+        if attachment.size > self.quota:
+            self.stats["too_large"] += 1
+            return
+
+        tmp, digest, size = await self.download(attachment)
+        await self.run_in_executor(self.store_blob, tmp, self.blob_path(digest))
+
+        result = await self.db.attachment_blob.update_one(
+            {"_id": digest},
+            {
+                "$set": {"last_used": datetime.utcnow()},
+                "$setOnInsert": {"size": size, "pinned": False},
+            },
+            upsert=True,
+        )
+
+        # Only the worker that created the blob counts it, even if two stored the same file
+        if result.upserted_id is not None:
+            self.used += size
+            self.stats["stored"] += 1
+        else:
+            self.stats["deduplicated"] += 1
+
+        await self.db.attachment.update_one(
+            {"_id": attachment.id},
+            {"$set": {"message_id": message_id, "filename": attachment.filename, "hash": digest}},
+            upsert=True,
+        )
+
+        # mark_deleted can't find the blob of a message deleted before the above was written
+        if message_id in self.deleted:
+            await self.db.attachment_blob.update_one({"_id": digest}, {"$set": {"pinned": True}})
+
+        if self.used > self.quota:
+            await self.evict()
+
+    async def evict(self):
+        for pinned in (False, True):
+            blobs = self.db.attachment_blob.find({"pinned": pinned}).sort("last_used", 1)
+            async for blob in blobs:
+                if self.used <= self.quota:
+                    return
+                path = self.blob_path(blob["_id"])
+                await self.run_in_executor(functools.partial(path.unlink, missing_ok=True))
+                await self.db.attachment_blob.delete_one({"_id": blob["_id"]})
+                self.used -= blob["size"]
+                self.stats["evicted"] += 1
+
+    async def expire(self, before):
+        """Deletes blobs last used before a time, and files saved before blobs existed."""
+
+        count = 0
+        async for blob in self.db.attachment_blob.find({"last_used": {"$lt": before}}):
+            self.blob_path(blob["_id"]).unlink(missing_ok=True)
+            await self.db.attachment_blob.delete_one({"_id": blob["_id"]})
+            self.used -= blob["size"]
+            count += 1
+
+        cutoff = before.replace(tzinfo=timezone.utc).timestamp()
+        for path in self.root.iterdir():
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink()
+                count += 1
+
+        self.stats["expired"] += count
+        return count
+
+    async def mark_deleted(self, message_ids):
+        """Pins the blobs of deleted messages so they are evicted last."""
+
+        self.deleted.update(x for x in message_ids if x in self.queued)
+        query = {"message_id": {"$in": list(message_ids)}}
+        digests = [x["hash"] async for x in self.db.attachment.find(query, {"hash": 1})]
+        if len(digests) > 0:
+            query = {"_id": {"$in": digests}}
+            await self.db.attachment_blob.update_many(query, {"$set": {"pinned": True}})
+
+    async def close(self, timeout=10):
+        """Waits up to timeout seconds for queued downloads, then drops the rest."""
+
+        if self._setup_task.done():
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        self.stats["dropped"] += self.queue.qsize() + self.active
+        self._setup_task.cancel()
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
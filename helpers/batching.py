@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import asyncio
+import sys
+import time
+import traceback
+from collections import Counter
+
+
+class BatchWriter:
+    """Buffers documents by ID and hands them to a write coroutine in batches.
+
+    A batch is written every `interval` seconds, or as soon as `max_batch` documents are
+    buffered. Once `max_pending` documents are waiting, put blocks until the next write
+    completes. Buffered documents can still be modified in place through get.
+    """
+
+    def __init__(self, write, max_batch=500, interval=0.5, max_pending=10000):
+        self.write = write
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self.pending = {}
+        self.inflight = {}
+        self.stats = Counter()
+        self._wake = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._lock = asyncio.Lock()
+        self._written = None
+        self._task = None
+
+    def start(self, loop):
+        self._task = loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush_batch()
+            except Exception as error:
+                print("Ignoring exception in batch writer:", file=sys.stderr)
+                traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+                await asyncio.sleep(self.interval)
+
+    async def put(self, doc):
+        if len(self.pending) >= self.max_pending:
+            self.stats["blocked"] += 1
+            start = time.perf_counter()
+            while len(self.pending) >= self.max_pending:
+                self._not_full.clear()
+                await self._not_full.wait()
+            self.stats["blocked_ms"] += int((time.perf_counter() - start) * 1000)
+
+        self.pending[doc["_id"]] = doc
+        self.stats["queued"] += 1
+        self.stats["max_pending"] = max(self.stats["max_pending"], len(self.pending))
+        if len(self.pending) >= self.max_batch:
+            self._wake.set()
+
+    def get(self, id):
+        return self.pending.get(id)
+
+    async def wait_written(self, ids):
+        """Waits until none of the given IDs are part of a write in progress."""
+
+        if self._written is not None and any(x in self.inflight for x in ids):
+            await asyncio.shield(self._written)
+
+    async def flush_batch(self):
+        async with self._lock:
+            if len(self.pending) == 0:
+                return
+
+            batch, self.pending = self.pending, {}
+            self._not_full.set()
+            self.inflight = batch
+            self._written = asyncio.get_event_loop().create_future()
+
+            start = time.perf_counter()
+            try:
+                await self.write(list(batch.values()))
+            except BaseException:
+                # Requeue in front of anything buffered since, including on cancellation
+                self.pending = {**batch, **self.pending}
+                self.stats["failed_batches"] += 1
+                raise
+            else:
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["write_ms"] += int((time.perf_counter() - start) * 1000)
+            finally:
+                self.inflight = {}
+                self._written.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        while len(self.pending) > 0:
+            await self.flush_batch()
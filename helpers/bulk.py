@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import asyncio
+import time
+
+
+async def run_bulk(func, items, concurrency=5, per_second=10, progress=None, interval=2):
+    """Awaits func(item) for every item, with bounded concurrency and a cap on start rate.
+
+    discord.py already waits out per-route rate limits, so the cap mostly keeps bulk
+    edits under the global limit and leaves room for everything else the bot does.
+    progress, if given, is awaited with (done, total) every interval seconds and once at
+    the end. Returns a list of (item, exception) for the items that failed.
+    """
+
+    items = list(items)
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+    done = 0
+
+    async def run(item):
+        nonlocal done
+        try:
+            await func(item)
+        except Exception as error:
+            failures.append((item, error))
+        finally:
+            done += 1
+            semaphore.release()
+
+    async def report():
+        while True:
+            await asyncio.sleep(interval)
+            await progress(done, len(items))
+
+    reporter = None if progress is None else asyncio.ensure_future(report())
+    tasks = []
+    next_start = time.monotonic()
+    try:
+        for item in items:
+            await semaphore.acquire()
+            delay = next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_start = max(next_start, time.monotonic()) + 1 / per_second
+            tasks.append(asyncio.ensure_future(run(item)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if reporter is not None:
+            reporter.cancel()
+
+    if progress is not None:
+        await progress(done, len(items))
+    return failures
@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import asyncio
+from datetime import datetime, timedelta
+
+
+class RankIndex:
+    """Mirrors a numeric field of the member collection in a Redis sorted set, so ranks and
+    leaderboard pages don't need to sort or count the collection."""
+
+    def __init__(self, bot, field, batch_size=1000):
+        self.bot = bot
+        self.field = field
+        self.key = f"rank:{field}"
+        self.batch_size = batch_size
+
+    async def rebuild(self):
+        tmp_key = f"{self.key}:rebuild"
+        await self.bot.redis.delete(tmp_key)
+
+        count, batch = 0, []
+        query = {self.field: {"$gt": 0}}
+        async for x in self.bot.mongo.db.member.find(query, {self.field: 1}):
+            batch.extend((x[self.field], x["_id"]))
+            if len(batch) >= 2 * self.batch_size:
+                count += await self.bot.redis.zadd(tmp_key, *batch)
+                batch = []
+        if len(batch) > 0:
+            count += await self.bot.redis.zadd(tmp_key, *batch)
+
+        if count == 0:
+            await self.bot.redis.delete(self.key)
+        else:
+            await self.bot.redis.rename(tmp_key, self.key)
+        return count
+
+    async def set(self, member_id, score):
+        await self.bot.redis.zadd(self.key, score, member_id)
+
+    async def incr(self, member_id, amount):
+        await self.bot.redis.zincrby(self.key, amount, member_id)
+
+    async def count(self):
+        return await self.bot.redis.zcard(self.key)
+
+    async def rank(self, score):
+        """Returns the 1-indexed rank of a score, with ties sharing the same rank."""
+
+        redis = self.bot.redis
+        return await redis.zcount(self.key, score, exclude=redis.ZSET_EXCLUDE_MIN) + 1
+
+    async def entries(self, start=0, page_size=50):
+        """Yields member documents in descending order of the field, a page at a time."""
+
+        while True:
+            page = await self.bot.redis.zrevrange(
+                self.key, start, start + page_size - 1, withscores=True
+            )
+            if len(page) == 0:
+                return
+
+            ids = [int(x) for x, _ in page]
+            docs = self.bot.mongo.db.member.find({"_id": {"$in": ids}})
+            docs = {x["_id"]: x async for x in docs}
+
+            for member_id, (_, score) in zip(ids, page):
+                base = {"_id": member_id, "name": "Unknown User", "discriminator": "0000"}
+                yield {**docs.get(member_id, base), self.field: int(score)}
+
+            start += page_size
+
+
+class LeaderboardSnapshot:
+    """Keeps the top entries of a RankIndex rendered in memory.
+
+    The snapshot is refreshed when it is requested after max_age has passed or after
+    max_changes calls to mark_changed. Entries past the top are read from the index.
+    """
+
+    def __init__(self, ranks, format_item, size=100, max_age=timedelta(minutes=5), max_changes=50):
+        self.ranks = ranks
+        self.format_item = format_item
+        self.size = size
+        self.max_age = max_age
+        self.max_changes = max_changes
+
+        self.fields = []
+        self.count = 0
+        self.updated_at = None
+        self.changes = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def stale(self):
+        return (
+            self.updated_at is None
+            or self.changes >= self.max_changes
+            or datetime.utcnow() - self.updated_at > self.max_age
+        )
+
+    def mark_changed(self):
+        self.changes += 1
+
+    async def refresh(self):
+        async with self._lock:
+            if not self.stale:
+                return
+            changes = self.changes
+            fields = []
+            async for x in self.ranks.entries(page_size=self.size):
+                if len(fields) >= self.size:
+                    break
+                fields.append(self.format_item(len(fields), x))
+
+            self.fields = fields
+            self.count = await self.ranks.count()
+            self.updated_at = datetime.utcnow()
+            self.changes -= changes
+
+    async def entries(self):
+        if self.stale:
+            await self.refresh()
+        for field in self.fields:
+            yield field
+        if len(self.fields) < self.size:
+            return
+        i = self.size
+        async for x in self.ranks.entries(start=self.size):
+            yield self.format_item(i, x)
+            i += 1
@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import gzip
+import os
+import queue
+import shutil
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
+
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def rotating_file_handler(path, max_bytes=0, when=None, backup_count=10, compress=False):
+    """Returns a file handler rotated by time if `when` is given, otherwise by size."""
+
+    if when is not None:
+        handler = TimedRotatingFileHandler(
+            path, when=when, backupCount=backup_count, encoding="utf-8"
+        )
+    else:
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    if compress:
+        handler.namer = lambda name: f"{name}.gz"
+        handler.rotator = gzip_rotator
+    return handler
+
+
+def expire_rotated(directory, before):
+    """Deletes rotated log files last modified before a POSIX timestamp."""
+
+    count = 0
+    for entry in os.scandir(directory):
+        if ".log." in entry.name and entry.is_file() and entry.stat().st_mtime < before:
+            os.remove(entry.path)
+            count += 1
+    return count
+
+
+class QueueLogging:
+    """Moves file output for loggers onto background threads.
+
+    Each attached logger only puts records on a queue, and a QueueListener thread formats
+    them and writes them to the file handler, so slow disks and rotation never block the
+    event loop.
+    """
+
+    def __init__(self):
+        self.listeners = []
+
+    def attach(self, logger, handler):
+        records = queue.SimpleQueue()
+        logger.handlers = [QueueHandler(records)]
+        listener = QueueListener(records, handler, respect_handler_level=True)
+        listener.start()
+        self.listeners.append(listener)
+
+    def stop(self):
+        """Writes out queued records and closes the file handlers."""
+
+        listeners, self.listeners = self.listeners, []
+        for listener in listeners:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
@@ -0,0 +1,331 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import itertools
+import re
+import unicodedata
+from collections import deque
+
+ZERO_WIDTH = "\u00ad\u034f\u180e\u200b\u200c\u200d\u200e\u200f\u2060\u2061\u2062\u2063\u2064\ufeff"
+
+# fmt: off
+CONFUSABLES = {
+    # Cyrillic
+    "а": "a", "в": "b", "е": "e", "ё": "e", "к": "k", "м": "m", "н": "h", "о": "o", "р": "p",
+    "с": "c", "т": "t", "у": "y", "х": "x", "і": "i", "ї": "i", "ј": "j", "ѕ": "s", "ԁ": "d",
+    "ԛ": "q", "ԝ": "w", "һ": "h", "ɡ": "g",
+    # Greek
+    "α": "a", "β": "b", "ε": "e", "η": "n", "ι": "i", "κ": "k", "ν": "v", "ο": "o", "ρ": "p",
+    "τ": "t", "υ": "u", "χ": "x", "ω": "w",
+    # Latin lookalikes without a decomposition
+    "ı": "i", "ł": "l", "ø": "o", "đ": "d", "ħ": "h", "ŧ": "t",
+}
+# fmt: on
+
+LEETSPEAK = {
+    "0": "o",
+    "1": "i",
+    "3": "e",
+    "4": "a",
+    "5": "s",
+    "7": "t",
+    "8": "b",
+    "@": "a",
+    "$": "s",
+}
+
+# Latin-1 and Latin Extended, combining marks, enclosed, fullwidth and mathematical letters
+DECOMPOSABLE = itertools.chain(
+    range(0xC0, 0x250),
+    range(0x1E00, 0x1F00),
+    range(0x2460, 0x24EA),
+    range(0xFF01, 0xFF5F),
+    range(0x1D400, 0x1D800),
+    range(0x1F130, 0x1F18A),
+)
+
+
+def build_normalize_table():
+    table = {}
+    for codepoint in DECOMPOSABLE:
+        decomposed = unicodedata.normalize("NFKD", chr(codepoint))
+        base = "".join(x for x in decomposed if not unicodedata.combining(x)).casefold()
+        if len(base) == 1 and base.isascii() and base != chr(codepoint):
+            table[codepoint] = base
+    table.update({ord(k): v for k, v in CONFUSABLES.items()})
+    table.update({x: None for x in range(0x300, 0x370)})
+    table.update({ord(x): None for x in ZERO_WIDTH})
+    return table
+
+
+NORMALIZE_TABLE = build_normalize_table()
+LEETSPEAK_TABLE = str.maketrans(LEETSPEAK)
+LEETSPEAK_REGEX = re.compile(f"[{re.escape(''.join(LEETSPEAK))}]")
+# Words made only of digits and symbols, like "455" or "$100"
+NUMBER_REGEX = re.compile(r"(?<![\w@$])[\d_@$]+(?![\w@$])")
+RUN_REGEX = re.compile(r"(.)\1{2,}")
+REPEAT_REGEX = re.compile(r"(.)\1+")
+
+
+def translate(text):
+    # Digits and symbols are only read as letters in words that also have letters, so
+    # "h3ll0" becomes "hello" but numbers like "455" are left alone.
+    text = text.casefold().translate(NORMALIZE_TABLE)
+    if LEETSPEAK_REGEX.search(text) is None:
+        return text
+
+    pieces, start = [], 0
+    for match in NUMBER_REGEX.finditer(text):
+        pieces.append(text[start : match.start()].translate(LEETSPEAK_TABLE))
+        pieces.append(match.group())
+        start = match.end()
+    pieces.append(text[start:].translate(LEETSPEAK_TABLE))
+    return "".join(pieces)
+
+
+def shorten_runs(text):
+    return RUN_REGEX.sub(r"\1\1", text)
+
+
+def collapse_runs(text):
+    """Returns text with each run of a character collapsed to one, and the lengths of the
+    runs longer than one, keyed by their index in the collapsed text."""
+
+    pieces, runs, start, removed = [], {}, 0, 0
+    for match in REPEAT_REGEX.finditer(text):
+        pieces.append(text[start : match.start() + 1])
+        runs[match.start() - removed] = match.end() - match.start()
+        removed += match.end() - match.start() - 1
+        start = match.end()
+    if start == 0:
+        return text, runs
+    pieces.append(text[start:])
+    return "".join(pieces), runs
+
+
+def normalize(text):
+    """Maps text onto the plain form automod matches against.
+
+    Lookalike characters are replaced with their ASCII equivalents, diacritics and
+    zero-width characters are removed, leetspeak in words is decoded, and runs of three
+    or more of the same character are collapsed to two.
+    """
+
+    return shorten_runs(translate(text))
+
+
+def is_boundary(text, idx):
+    return idx < 0 or idx >= len(text) or not text[idx].isalnum()
+
+
+class PhraseMatcher:
+    """Aho-Corasick automaton matching many phrases in a single pass over the text.
+
+    Phrases match on word boundaries by default. A leading or trailing `*` drops the
+    boundary requirement on that side, so `*foo*` matches anywhere inside a word.
+    """
+
+    def __init__(self, phrases):
+        self.phrases = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for phrase in phrases:
+            self.add(phrase)
+        self.build()
+
+    def add(self, phrase):
+        left, right = phrase.startswith("*"), phrase.endswith("*")
+        text = phrase.strip("*")
+        if len(text) > 0:
+            self.insert(text, left, right)
+            self.phrases.append(phrase)
+
+    def insert(self, text, left, right):
+        state = 0
+        for char in text:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+
+        self.output[state] += ((len(text), not left, not right, len(self.phrases)),)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def matches(self, text):
+        """Yields the start, end and phrase index of each match in text."""
+
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for idx, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, left, right, phrase_idx in output[state]:
+                start = idx - length + 1
+                if left and not is_boundary(text, start - 1):
+                    continue
+                if right and not is_boundary(text, idx + 1):
+                    continue
+                yield start, idx + 1, phrase_idx
+
+    def finditer(self, text):
+        for _, _, phrase_idx in self.matches(text):
+            yield self.phrases[phrase_idx]
+
+    def search(self, text):
+        return next(self.finditer(text), None)
+
+
+class StretchedPhraseMatcher(PhraseMatcher):
+    """PhraseMatcher that also matches phrases with their letters stretched out.
+
+    Phrases and text are matched with each run of a character collapsed to one. A run in
+    the text then has to be as long as the one in the phrase, or longer than both it and
+    two, so "hhheeellllooo" matches `hello` but "good" doesn't match `god`. At a wildcard
+    end, the phrase may also match part of a longer run.
+    """
+
+    def __init__(self, phrases):
+        self.runs = []
+        super().__init__(phrases)
+
+    def add(self, phrase):
+        left, right = phrase.startswith("*"), phrase.endswith("*")
+        text, runs = collapse_runs(phrase.strip("*"))
+        if len(text) > 0:
+            self.insert(text, left, right)
+            self.phrases.append(phrase)
+            self.runs.append((runs, left, right))
+
+    def finditer(self, text):
+        text, runs = collapse_runs(text)
+        for start, end, phrase_idx in self.matches(text):
+            phrase_runs, left, right = self.runs[phrase_idx]
+            for idx in range(start, end):
+                count, length = runs.get(idx, 1), phrase_runs.get(idx - start, 1)
+                partial = (left and idx == start) or (right and idx == end - 1)
+                if count == length or count > max(length, 2) or (partial and count > length):
+                    continue
+                break
+            else:
+                yield self.phrases[phrase_idx]
+
+
+INVITE_REGEX = re.compile(
+    r"(?:https?://)?(?:www\.)?(?:discord(?:app)?\.com/invite|discord\.gg)/([\w-]+)", re.I
+)
+URL_REGEX = re.compile(r"https?://(?:[^\s/@]*@)?([^\s/?#:<>\"'|]+)", re.I)
+RULE_REGEX = re.compile(r"(?:https?://)?((?:\*\.)?[\w.-]+)/?")
+
+
+def parse_domain_rule(rule):
+    """Returns the canonical form of a domain or invite rule, or None if it is invalid."""
+
+    match = INVITE_REGEX.fullmatch(rule)
+    if match is not None:
+        return f"discord.gg/{match.group(1)}"
+    match = RULE_REGEX.fullmatch(rule)
+    if match is None or "." not in match.group(1):
+        return None
+    return match.group(1).casefold().strip(".")
+
+
+def rule_labels(rule):
+    if rule.startswith("discord.gg/"):
+        return ["gg", "discord", rule[len("discord.gg/") :]]
+    return rule.split(".")[::-1]
+
+
+class DomainTrie:
+    """Suffix trie over reversed domain labels, looked up in O(labels).
+
+    A rule for `example.com` covers the domain and all of its subdomains, while
+    `*.example.com` covers only the subdomains. Invites are stored as `discord.gg/<code>`,
+    with the code as the last label, so they can override a rule for `discord.gg`. The
+    most specific matching rule decides the verdict.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def split_rule(self, rule):
+        if rule.startswith("*."):
+            return rule_labels(rule[2:]), "*"
+        return rule_labels(rule), None
+
+    def add(self, rule, verdict):
+        labels, key = self.split_rule(rule)
+        node = self.root
+        for label in labels:
+            node = node.setdefault(label, {})
+        if key not in node:
+            self.size += 1
+        node[key] = verdict
+
+    def remove(self, rule):
+        labels, key = self.split_rule(rule)
+        path = [self.root]
+        for label in labels:
+            if label not in path[-1]:
+                return
+            path.append(path[-1][label])
+
+        if path[-1].pop(key, None) is None:
+            return
+        self.size -= 1
+
+        # Prune nodes left without rules or children
+        for label, node in zip(reversed(labels), reversed(path[:-1])):
+            if len(node[label]) > 0:
+                break
+            del node[label]
+
+    def lookup(self, labels):
+        node, verdict = self.root, None
+        for label in labels:
+            verdict = node.get("*", verdict)
+            node = node.get(label)
+            if node is None:
+                break
+            verdict = node.get(None, verdict)
+        return verdict
+
+    def __len__(self):
+        return self.size
+
+    def finditer(self, text, verdict="block"):
+        if self.size == 0:
+            return
+        for match in INVITE_REGEX.finditer(text):
+            link = f"discord.gg/{match.group(1)}"
+            if self.lookup(rule_labels(link)) == verdict:
+                yield link
+        for match in URL_REGEX.finditer(INVITE_REGEX.sub(" ", text)):
+            host = match.group(1).casefold().strip(".")
+            if self.lookup(host.split(".")[::-1]) == verdict:
+                yield host
+
+    def search(self, text, verdict="block"):
+        return next(self.finditer(text, verdict), None)
@@ -56,12 +56,14 @@ class AsyncFieldsPageSource(menus.AsyncIteratorPageSource):
         count=None,
         format_item=lambda i, x: (i, x),
         format_embed=lambda x: None,
+        footer=None,
     ):
         super().__init__(data, per_page=5)
         self.title = title
         self.format_item = format_item
         self.format_embed = format_embed
         self.count = count
+        self.footer = footer
 
     async def format_page(self, menu, entries):
         embed = discord.Embed(
@@ -76,6 +78,8 @@ class AsyncFieldsPageSource(menus.AsyncIteratorPageSource):
         footer = f"Showing entries {start+1}–{i+1}"
         if self.count is not None:
             footer += f" out of {self.count}"
+        if self.footer is not None:
+            footer += f" • {self.footer}"
         embed.set_footer(text=footer)
         return embed
 
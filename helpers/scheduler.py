@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import asyncio
+import heapq
+import sys
+import traceback
+from datetime import datetime
+
+
+class TimerHeap:
+    """Calls a coroutine function with each key once its deadline (a naive UTC datetime) passes.
+
+    Deadlines are kept in a min-heap and the runner sleeps until the earliest one, waking
+    early when an earlier deadline is scheduled. Rescheduled and cancelled keys are
+    skipped lazily when they reach the top. A key is never run again while its previous
+    call is still in flight.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.deadlines = {}
+        self.inflight = set()
+        self._tasks = set()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self, loop):
+        self._task = loop.create_task(self.run())
+
+    def schedule(self, key, when):
+        if self.deadlines.get(key) == when:
+            return
+        self.deadlines[key] = when
+        heapq.heappush(self.heap, (when, key))
+        if self.heap[0] == (when, key):
+            self._wake.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            while len(self.heap) > 0 and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+
+            if len(self.heap) == 0:
+                await self._wake.wait()
+                continue
+
+            delay = (self.heap[0][0] - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            if key in self.inflight:
+                continue
+            self.inflight.add(key)
+            task = asyncio.get_event_loop().create_task(self.fire(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception as error:
+            print(f"Ignoring exception in timer for {key}:", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        finally:
+            self.inflight.discard(key)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,368 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+import os
+import pickle
+import re
+from array import array
+from bisect import bisect_left
+
+BLOCK_SIZE = 128
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return {x for x in TOKEN_REGEX.findall(text.casefold()) if len(x) > 1}
+
+
+def channel_token(channel_id):
+    return f"\0c{channel_id}"
+
+
+def user_token(user_id):
+    return f"\0u{user_id}"
+
+
+def encode_block(ids):
+    """Encodes sorted IDs as varints of the differences between them."""
+
+    data, prev = bytearray(), 0
+    for x in ids:
+        delta, prev = x - prev, x
+        while delta >= 0x80:
+            data.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return bytes(data)
+
+
+def decode_block(data):
+    ids, value, shift, prev = [], 0, 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            prev += value
+            ids.append(prev)
+            value = shift = 0
+    return ids
+
+
+class PostingList:
+    """A sorted set of message IDs, stored as compressed blocks plus an uncompressed tail.
+
+    New IDs are almost always the largest so far and go on the tail, which is sealed into
+    a block once full. IDs that arrive late are inserted into the block they belong in.
+    """
+
+    __slots__ = ("firsts", "lasts", "blocks", "tail")
+
+    def __init__(self):
+        self.firsts = array("Q")
+        self.lasts = array("Q")
+        self.blocks = []
+        self.tail = []
+
+    def __len__(self):
+        return len(self.blocks) * BLOCK_SIZE + len(self.tail)
+
+    def add(self, id):
+        if len(self.lasts) > 0 and id <= self.lasts[-1]:
+            i = bisect_left(self.lasts, id)
+            ids = decode_block(self.blocks[i])
+            j = bisect_left(ids, id)
+            if j < len(ids) and ids[j] == id:
+                return
+            ids.insert(j, id)
+            self.blocks[i] = encode_block(ids)
+            self.firsts[i] = ids[0]
+            return
+
+        if len(self.tail) == 0 or id > self.tail[-1]:
+            self.tail.append(id)
+        else:
+            j = bisect_left(self.tail, id)
+            if self.tail[j] == id:
+                return
+            self.tail.insert(j, id)
+
+        if len(self.tail) >= BLOCK_SIZE:
+            self.firsts.append(self.tail[0])
+            self.lasts.append(self.tail[-1])
+            self.blocks.append(encode_block(self.tail))
+            self.tail = []
+
+    def iter_desc(self, after=None, before=None):
+        """Yields IDs in (after, before) from largest to smallest."""
+
+        low = -1 if after is None else after
+        high = float("inf") if before is None else before
+
+        for x in reversed(self.tail):
+            if x <= low:
+                return
+            if x < high:
+                yield x
+
+        for i in reversed(range(bisect_left(self.firsts, high))):
+            if self.lasts[i] <= low:
+                return
+            for x in reversed(decode_block(self.blocks[i])):
+                if x <= low:
+                    return
+                if x < high:
+                    yield x
+
+    def contains(self):
+        """Returns a membership test that keeps the last block it decoded.
+
+        Lookups for nearby IDs, such as candidates checked in order, rarely decode twice.
+        """
+
+        cache = {}
+
+        def check(id):
+            if len(self.tail) > 0 and id >= self.tail[0]:
+                j = bisect_left(self.tail, id)
+                return j < len(self.tail) and self.tail[j] == id
+            i = bisect_left(self.lasts, id)
+            if i == len(self.lasts) or self.firsts[i] > id:
+                return False
+            if i not in cache:
+                cache.clear()
+                cache[i] = decode_block(self.blocks[i])
+            ids = cache[i]
+            j = bisect_left(ids, id)
+            return j < len(ids) and ids[j] == id
+
+        return check
+
+
+class SmallPostingList:
+    """Read-only PostingList interface over a sorted tuple of IDs."""
+
+    __slots__ = ("ids",)
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def iter_desc(self, after=None, before=None):
+        low = -1 if after is None else after
+        high = float("inf") if before is None else before
+        for x in reversed(self.ids):
+            if x <= low:
+                return
+            if x < high:
+                yield x
+
+    def contains(self):
+        def check(id):
+            j = bisect_left(self.ids, id)
+            return j < len(self.ids) and self.ids[j] == id
+
+        return check
+
+
+class SearchIndex:
+    """An inverted index from tokens to the messages containing them.
+
+    Channels and authors are indexed as special tokens, so filters are intersected just
+    like words. Deleted messages are kept in the postings and tombstoned.
+
+    Most tokens only ever appear in a few messages, so postings are stored as a single
+    ID, then a sorted tuple, and only become a PostingList once they fill a block.
+
+    Changes since the last call to take_changes are recorded, so the index can be saved
+    as a snapshot plus a journal of changes instead of being rewritten each time.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.tombstones = set()
+        self.last_id = 0
+        self.changes = []
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != "changes"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.changes = []
+
+    def add_tokens(self, message_id, tokens):
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                self.postings[token] = message_id
+            elif isinstance(postings, int):
+                if postings != message_id:
+                    self.postings[token] = tuple(sorted((postings, message_id)))
+            elif isinstance(postings, tuple):
+                j = bisect_left(postings, message_id)
+                if j < len(postings) and postings[j] == message_id:
+                    continue
+                postings = postings[:j] + (message_id,) + postings[j:]
+                if len(postings) >= BLOCK_SIZE:
+                    ids, postings = postings, PostingList()
+                    for x in ids:
+                        postings.add(x)
+                self.postings[token] = postings
+            else:
+                postings.add(message_id)
+
+    def get_postings(self, token):
+        postings = self.postings.get(token)
+        if isinstance(postings, int):
+            return SmallPostingList((postings,))
+        if isinstance(postings, tuple):
+            return SmallPostingList(postings)
+        return postings
+
+    def add(self, message_id, channel_id, user_id, content):
+        tokens = tokenize(content)
+        tokens.add(channel_token(channel_id))
+        tokens.add(user_token(user_id))
+        self.add_tokens(message_id, tokens)
+        self.last_id = max(self.last_id, message_id)
+        self.changes.append(("add", message_id, tokens))
+
+    def add_edit(self, message_id, content):
+        tokens = tokenize(content)
+        self.add_tokens(message_id, tokens)
+        self.changes.append(("edit", message_id, tokens))
+
+    def delete(self, message_ids):
+        message_ids = list(message_ids)
+        self.tombstones.update(message_ids)
+        self.changes.append(("delete", message_ids))
+
+    def replay(self, changes):
+        for change in changes:
+            if change[0] == "delete":
+                self.tombstones.update(change[1])
+                continue
+            _, message_id, tokens = change
+            self.add_tokens(message_id, tokens)
+            if change[0] == "add":
+                self.last_id = max(self.last_id, message_id)
+
+    def take_changes(self):
+        changes, self.changes = self.changes, []
+        return changes
+
+    def search(
+        self,
+        text,
+        channel_id=None,
+        user_id=None,
+        after=None,
+        before=None,
+        include_deleted=False,
+    ):
+        """Yields IDs of messages containing every word in text, from newest to oldest.
+
+        after and before are exclusive snowflake bounds.
+        """
+
+        tokens = tokenize(text)
+        if channel_id is not None:
+            tokens.add(channel_token(channel_id))
+        if user_id is not None:
+            tokens.add(user_token(user_id))
+        if len(tokens) == 0:
+            return
+
+        postings = [self.get_postings(x) for x in tokens]
+        if any(x is None for x in postings):
+            return
+
+        # Walk the shortest list and probe the others
+        postings.sort(key=len)
+        checks = [x.contains() for x in postings[1:]]
+        for id in postings[0].iter_desc(after, before):
+            if not include_deleted and id in self.tombstones:
+                continue
+            if all(check(id) for check in checks):
+                yield id
+
+
+# Saved indexes are a pickled snapshot at path, plus journals of pickled change lists. New
+# changes are appended to path.journal. To compact, the journal is first renamed to
+# path.journal.old, so changes can keep being appended while the snapshot is rewritten.
+# Replaying a change twice has no effect, so a compaction interrupted at any point only
+# leaves extra work for the next load.
+
+
+def append_changes(path, changes, chunk_size=10000):
+    # Pickling holds the GIL, so write in chunks to let the event loop run in between
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.journal", "ab") as f:
+        for i in range(0, len(changes), chunk_size):
+            chunk = changes[i : i + chunk_size]
+            f.write(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def replay_journal(index, path):
+    """Replays a journal into an index, truncating a partially written last record."""
+
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            offset = f.tell()
+            try:
+                index.replay(pickle.load(f))
+            except EOFError:
+                return
+            except pickle.UnpicklingError:
+                f.truncate(offset)
+                return
+
+
+def load_snapshot(path):
+    if not os.path.exists(path):
+        return SearchIndex()
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def load_index(path):
+    index = load_snapshot(path)
+    replay_journal(index, f"{path}.journal.old")
+    replay_journal(index, f"{path}.journal")
+    return index
+
+
+def journal_size(path):
+    try:
+        return os.path.getsize(f"{path}.journal")
+    except FileNotFoundError:
+        return 0
+
+
+def rotate_journal(path):
+    """Starts a compaction, unless an unfinished one left path.journal.old behind."""
+
+    if not os.path.exists(f"{path}.journal.old") and os.path.exists(f"{path}.journal"):
+        os.replace(f"{path}.journal", f"{path}.journal.old")
+
+
+def compact_index(path):
+    """Folds path.journal.old into the snapshot. Meant to be run in another process."""
+
+    index = load_snapshot(path)
+    replay_journal(index, f"{path}.journal.old")
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+    if os.path.exists(f"{path}.journal.old"):
+        os.remove(f"{path}.journal.old")
@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+from collections import OrderedDict, deque
+
+
+class SpamDetector:
+    """Tracks message floods and duplicated messages in bounded memory.
+
+    Every check is amortized constant time. Floods use a sliding window of each user's last
+    `count` message times, evicted in least-recently-used order. Duplicates use a table of content fingerprints in the order
+    they were first seen, so expired entries are always at the front.
+    """
+
+    def __init__(self, max_users=10000, max_fingerprints=10000, min_length=10):
+        self.max_users = max_users
+        self.max_fingerprints = max_fingerprints
+        self.min_length = min_length
+        self.recent = OrderedDict()
+        self.fingerprints = OrderedDict()
+
+    def check_flood(self, user_id, now, count, per):
+        """Returns whether this is at least the count-th message from the user within per."""
+
+        times = self.recent.pop(user_id, None)
+        if times is None or times.maxlen != count:
+            times = deque(maxlen=count)
+        times.append(now)
+
+        self.recent[user_id] = times
+        if len(self.recent) > self.max_users:
+            self.recent.popitem(last=False)
+        return len(times) == count and now - times[0] < per
+
+    def check_duplicate(self, content, user_id, now, count, per):
+        """Returns whether at least count users sent this content within per."""
+
+        content = " ".join(content.casefold().split())
+        if len(content) < self.min_length:
+            return False
+
+        while self.fingerprints:
+            first_seen, _ = next(iter(self.fingerprints.values()))
+            if now - first_seen < per and len(self.fingerprints) < self.max_fingerprints:
+                break
+            self.fingerprints.popitem(last=False)
+
+        key = hash(content)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = (now, {user_id})
+            return count <= 1
+
+        _, users = self.fingerprints[key]
+        if len(users) < count:
+            users.add(user_id)
+        return len(users) >= count
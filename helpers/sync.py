@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Copyright (c) 2021 Oliver Ni
+
+
+def fingerprint(value):
+    return hash(repr(value))
+
+
+class FieldCache:
+    """Remembers a fingerprint of each field last written for every entity.
+
+    Call changes to get the fields that differ from the last write, and commit once the
+    write has succeeded. Entities that have never been committed count as fully changed.
+    """
+
+    def __init__(self):
+        self.fingerprints = {}
+
+    def changes(self, key, fields):
+        old = self.fingerprints.get(key, {})
+        return {k: v for k, v in fields.items() if old.get(k) != fingerprint(v)}
+
+    def commit(self, key, fields):
+        self.fingerprints.setdefault(key, {}).update((k, fingerprint(v)) for k, v in fields.items())
+
+    def forget(self, key):
+        self.fingerprints.pop(key, None)